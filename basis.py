@@ -10,7 +10,9 @@ import closure_operators
 import oracle
 import helper
 
+import multiprocessing
 import sys
+import time
 
 
 def kclosure(s, k, cxt):
@@ -37,7 +39,7 @@ def canonical_basis(cxt, close=closure_operators.simple_closure):
     preclosed = [(set(cxt.objects), set())]
     basis = []
     # each preclosed is (extent, intent) or (extent, premise, implication)
-    # assuming that premise and implication.premise are the same object
+    # where premise is implication.premise
     for i in range(len(cxt.attributes)):
         preclosed, basis = update_preclosed(i, cxt, preclosed, close)
     return basis
@@ -84,11 +86,11 @@ def update_preclosed(i, cxt, preclosed,
     for j in range(len(non_min_mod) - 1, -1, -1):
         impl = non_min_mod[j][2]
         del basis[n + j]
-        premise = impl.premise
-        premise |= close(premise, basis)    # sic! changing impl.premise
-        if premise != impl.get_conclusion():
+        impl = imp.Implication(impl.premise | close(impl.premise, basis),
+                               impl.conclusion)
+        if impl.premise != impl.get_conclusion():
             basis.append(impl)
-            mod_extra.append(non_min_mod[j])
+            mod_extra.append((non_min_mod[j][0], impl.premise, impl))
 
     mod_extra.sort(cmp=compare_tuples)
 
@@ -117,15 +119,15 @@ def process_stable_concept(p, m, extent, new_stable_impl, new_preclosed,
 def process_modified_implication(p, m, min_mod_impl, non_min_mod,
                                  new_preclosed):
     # p is of the form (extent, premise, implication)
-    p[2].get_conclusion().add(m)
+    impl = imp.Implication(p[1], p[2].get_conclusion() | set([m]))
     for i in min_mod_impl:
         if i.premise <= p[1]:   # p[1] is no longer preclosed
-            p[1].add(m)         # assuming that p[1] is p[2].premise
-            non_min_mod.append(p)
+            impl = imp.Implication(impl.premise | set([m]), impl.conclusion)
+            non_min_mod.append((p[0], impl.premise, impl))
             break
     else:                       # p[1] remains psuedo-closed
-        min_mod_impl.append(p[2])
-        new_preclosed.append(p)
+        min_mod_impl.append(impl)
+        new_preclosed.append((p[0], impl.premise, impl))
 
 
 def process_modified_concept(p, m, min_mod_impl, mod_concepts, new_preclosed):
@@ -134,8 +136,7 @@ def process_modified_concept(p, m, min_mod_impl, mod_concepts, new_preclosed):
         if i.premise <= p[1]:   # p[1] is no longer preclosed
             break
     else:                       # p[1] becomes psuedo-closed
-        impl = imp.Implication(p[1].copy(), p[1].copy())
-        impl.get_conclusion().add(m)
+        impl = imp.Implication(p[1], p[1] | set([m]))
         min_mod_impl.append(impl)
         new_preclosed.append((p[0], impl.premise, impl))
     p[1].add(m)
@@ -183,11 +184,286 @@ def generalizedComputeDgBasis(attributes, aclose,
     return relative_basis
 
 
+def _dg_owner(bitset, parts):
+    """Index of the worker owning the candidate `bitset`"""
+    return hash((bitset,)) % parts
+
+
+class _DgPartition(object):
+    """
+    The candidates of parallelComputeDgBasis owned by one worker.
+
+    Candidates are attribute bitsets kept by size across levels, so a level
+    only handles the sets left at the previous one, and the implications
+    are compiled once and extended with the pseudo-intents of every level.
+    """
+
+    def __init__(self, context, imp_basis, part, parts):
+        self.part = part
+        self.parts = parts
+        self.full = (1 << len(context.attributes)) - 1
+        self.closure = closure_operators.CompiledClosure(imp_basis,
+                                                         context.attributes)
+        self.intents = context.objectBitsets()
+        self.extents = [0] * len(context.attributes)
+        for o, intent in enumerate(self.intents):
+            while intent:
+                bit = intent & -intent
+                intent ^= bit
+                self.extents[bit.bit_length() - 1] |= 1 << o
+        self.frontier = {}
+
+    def intent(self, bitset):
+        """Return the closure of bitset in the context"""
+        extent = (1 << len(self.intents)) - 1
+        while bitset:
+            bit = bitset & -bitset
+            bitset ^= bit
+            extent &= self.extents[bit.bit_length() - 1]
+        closed = self.full
+        while extent:
+            bit = extent & -extent
+            extent ^= bit
+            closed &= self.intents[bit.bit_length() - 1]
+        return closed
+
+    def add(self, bitset, outgoing):
+        owner = _dg_owner(bitset, self.parts)
+        if owner == self.part:
+            size = bin(bitset).count('1')
+            self.frontier.setdefault(size, set()).add(bitset)
+        else:
+            outgoing[owner].add(bitset)
+
+    def level(self, k, implications, incoming):
+        """
+        Process the candidates of size k once the pseudo-intents found at
+        the previous level are added to the implications.
+
+        Return the pseudo-intents found as (premise, conclusion) bitsets,
+        the new candidates owned by every other worker and the smallest
+        size left in the frontier.
+        """
+        for premise, conclusion in implications:
+            self.closure.append(premise, conclusion)
+        outgoing = [set() for part in range(self.parts)]
+        for bitset in incoming:
+            self.add(bitset, outgoing)
+        found = []
+        for a in self.frontier.pop(k, ()):
+            b = self.closure.closure_bitset(a)
+            if b != a:
+                self.add(b, outgoing)
+                continue
+            b = self.intent(a)
+            if b != a:
+                found.append((a, b))
+            rest = self.full & ~b
+            while rest:
+                bit = rest & -rest
+                rest ^= bit
+                self.add(b | bit, outgoing)
+        return found, outgoing, min(self.frontier) if self.frontier else None
+
+
+def _dg_worker(conn, context, imp_basis, part, parts):
+    partition = _DgPartition(context, imp_basis, part, parts)
+    while True:
+        conn.send(partition.level(*conn.recv()))
+
+
+def parallelComputeDgBasis(context, imp_basis=[], cond=lambda x: True,
+                           workers=None):
+    """Computes the Duquenne-Guigues basis of `context` on several processes.
+
+    The pseudo-intents are found level by level as in NextClosures: a set P
+    of size k is pseudo-closed iff it is not an intent and it is closed
+    under the implications of all pseudo-intents smaller than k. Every
+    worker owns a fixed share of the candidates and keeps it between
+    levels; after each level the workers exchange the new candidates and
+    receive the implications found at that level.
+    """
+    parts = workers or multiprocessing.cpu_count()
+    full = (1 << len(context.attributes)) - 1
+    connections = []
+    processes = []
+    if parts == 1:
+        partition = _DgPartition(context, imp_basis, 0, 1)
+    else:
+        for part in range(parts):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_dg_worker,
+                args=(child, context, imp_basis, part, parts))
+            process.daemon = True
+            process.start()
+            connections.append(conn)
+            processes.append(process)
+    relative_basis = []
+    try:
+        incoming = [set() for part in range(parts)]
+        incoming[_dg_owner(0, parts)].add(0)
+        new = []
+        k = 0
+        while k is not None:
+            if parts == 1:
+                results = [partition.level(k, new, incoming[0])]
+            else:
+                for conn, sets in zip(connections, incoming):
+                    conn.send((k, new, sets))
+                results = [conn.recv() for conn in connections]
+            found = []
+            incoming = [set() for part in range(parts)]
+            sizes = []
+            for part_found, outgoing, size in results:
+                found += part_found
+                for sets, more in zip(incoming, outgoing):
+                    sets |= more
+                if size is not None:
+                    sizes.append(size)
+            sizes += [min(bin(a).count('1') for a in sets)
+                      for sets in incoming if sets]
+            new = []
+            for a, b in sorted(found):
+                premise = context.bitsetAttributes(a)
+                if cond(premise):
+                    relative_basis.append(imp.Implication(
+                        premise, context.bitsetAttributes(b)))
+                    new.append((a, b))
+                    continue
+                # without a => b the sets between a and b stay candidates
+                rest = full & ~a
+                while rest:
+                    bit = rest & -rest
+                    rest ^= bit
+                    incoming[_dg_owner(a | bit, parts)].add(a | bit)
+                sizes.append(k + 1)
+            k = min(sizes) if sizes else None
+    finally:
+        # the workers only wait for the next level by now
+        for process in processes:
+            process.terminate()
+            process.join()
+    return relative_basis
+
+
+def minimal_transversals(edges):
+    """Returns the minimal transversals of a hypergraph using Berge's
+    algorithm. Edges and transversals are bitsets (ints)."""
+    transversals = [0]
+    for edge in sorted(set(edges), key=lambda e: bin(e).count('1')):
+        hitting = [t for t in transversals if t & edge]
+        extended = set()
+        for t in transversals:
+            if t & edge:
+                continue
+            bits = edge
+            while bits:
+                bit = bits & -bits
+                bits ^= bit
+                extended.add(t | bit)
+        # an extended set is minimal unless it contains a hitting one
+        transversals = hitting + [t for t in extended
+                                  if not any(h & t == h for h in hitting)]
+    return transversals
+
+
+def proper_premises(context):
+    """Returns a dict mapping each proper premise of `context` to the
+    attributes it is a proper premise for. Both are attribute bitsets.
+
+    P is a proper premise for m iff P is a minimal transversal of the
+    hypergraph {M \\ (g' ∪ {m}) : m ∉ g'}, see Ryssel, Distel and Borchmann:
+    Fast algorithms for implication bases and attribute exploration using
+    proper premises, 2014.
+    """
+    full = (1 << len(context.attributes)) - 1
+    intents = set(context.objectBitsets())
+    premises = {}
+    for i in range(len(context.attributes)):
+        m = 1 << i
+        # only the maximal intents without m yield minimal edges
+        candidates = [g for g in intents if not g & m]
+        maximal = [g for g in candidates
+                   if not any(g != h and g & h == g for h in candidates)]
+        edges = [full & ~(g | m) for g in maximal]
+        if 0 in edges:
+            # some object has every attribute but m
+            continue
+        for premise in minimal_transversals(edges):
+            premises[premise] = premises.get(premise, 0) | m
+    return premises
+
+
+def computeDirectBasis(context, basis_type='proper_premises'):
+    """Computes an iteration-free basis of `context` from its proper
+    premises: a single pass over the implications closes any set.
+
+    With basis_type 'proper_premises' every implication P => P ∪ P* holds
+    the attributes P is a proper premise for, with 'direct' it holds the
+    whole closure P => P''.
+    """
+    direct_basis = []
+    for premise, conclusion in proper_premises(context).items():
+        if basis_type == 'direct':
+            premise_set = context.bitsetAttributes(premise)
+            direct_basis.append(imp.Implication(
+                premise_set, closure_operators.aclosure(premise_set,
+                                                        context)))
+        else:
+            direct_basis.append(imp.Implication.from_bitsets(
+                premise, premise | conclusion, context.attributes))
+    return direct_basis
+
+
+def minimize_basis(implications, reduce_conclusions=False):
+    """Returns a minimum cover of `implications`, i.e. the Duquenne-Guigues
+    basis of the closure system they define (D. Maier: Minimum covers in
+    relational database model, 1980; A. Day: The lattice theory of
+    functional dependencies and normal decompositions, 1992).
+
+    Every conclusion is first saturated to the closure of its premise, which
+    merges implications with equivalent premises. Then each implication in
+    turn is dropped and its premise replaced by its closure under the
+    remaining ones; it is kept only if that does not already give the
+    conclusion. If `reduce_conclusions` is set, conclusion attributes which
+    follow from the premise through the other implications are removed too.
+    Conclusions always contain their premise.
+    """
+    engine = closure_operators.CompiledClosure(implications)
+    n = len(engine.premises)
+    for i in range(n):
+        engine.replace(i, engine.premises[i],
+                       engine.closure_bitset(engine.premises[i]))
+    for i in range(n):
+        premise, conclusion = engine.premises[i], engine.conclusions[i]
+        engine.disable(i)
+        premise = engine.closure_bitset(premise)
+        if premise != conclusion:
+            engine.replace(i, premise, conclusion)
+    if reduce_conclusions:
+        for i in range(n):
+            if not engine.active[i]:
+                continue
+            premise, conclusion = engine.premises[i], engine.conclusions[i]
+            extra = conclusion & ~premise
+            while extra:
+                bit = extra & -extra
+                extra ^= bit
+                engine.replace(i, premise, engine.conclusions[i] & ~bit)
+                if engine.closure_bitset(premise) & conclusion != conclusion:
+                    engine.replace(i, premise, engine.conclusions[i] | bit)
+    return [imp.Implication.from_bitsets(premise, conclusion,
+                                         engine.attributes)
+            for premise, conclusion in engine.implications()]
+
+
 def horn1(formal_concept, closure_operator, membership_oracle,
           equivalence_oracle=None):
     """Computes DG Basis for a given set of attributes using horn1 algorithm
     """
-    hypothesis = set()
+    hypothesis = imp.Hypothesis()
+    attributes = set(formal_concept.context.attributes)
     # NOTE: counter_example is a set
     while True:
         # sample `hypothesis` => set([a, e, d => c, b])
@@ -200,122 +476,134 @@ def horn1(formal_concept, closure_operator, membership_oracle,
         if counter_example['value'] is None:
             break
 
-        # starting edge case
-        if len(hypothesis) == 0:
-            hypothesis.add(imp.Implication(
-                frozenset(counter_example['value']),
-                frozenset(formal_concept.context.attributes)))
+        # if some implications don't repect the counter example (a positive
+        # one), modify their conclusions (also called strengthening)
+        violated = hypothesis.violated_by(counter_example['value'])
+        for key in violated:
+            hypothesis.strengthen(key, counter_example['value'])
+        if violated:
             continue
 
-        for implication in hypothesis.copy():
-            # if an implication doesn't repect the counter example,
-            # modify it's conclusion (also called strengthening)
-            if not implication.is_respected(counter_example['value']):
-                hypothesis.remove(implication)
-                hypothesis.add(imp.Implication(
-                    frozenset(implication.premise),
-                    frozenset(implication.conclusion.intersection(
-                        counter_example['value']))))
-            else:
-                # special_implication (A --> B) is the first implication
-                # such that it's premise(A) is not a subset of
-                # counter_example(C) and member(C ∩ A) is false. The latter
-                # condition can also be interpreted as C ∩ A is not a model
-                # of context(K)
-                special_implication = imp.findSpecialImplication(
-                    hypothesis,
-                    membership_oracle,
-                    closure_operator,
-                    counter_example['value'])
-                if special_implication:
-                    hypothesis.remove(special_implication)
-                    hypothesis.add(imp.Implication(
-                        frozenset(counter_example['value'].intersection(
-                            special_implication.premise)),
-                        frozenset(special_implication.conclusion.union(
-                            special_implication.premise.difference(
-                                counter_example['value'])))))
-                else:
-                    hypothesis.add(imp.Implication(
-                        counter_example['value'],
-                        set(formal_concept.context.attributes)))
-    return hypothesis
+        # special_implication (A --> B) is the first implication
+        # such that it's premise(A) is not a subset of
+        # counter_example(C) and member(C ∩ A) is false. The latter
+        # condition can also be interpreted as C ∩ A is not a model
+        # of context(K)
+        special_key = hypothesis.special_implication(
+            counter_example['value'], membership_oracle, closure_operator)
+        if special_key is not None:
+            hypothesis.refine(special_key, counter_example['value'])
+        else:
+            hypothesis.add(imp.Implication(counter_example['value'],
+                                           attributes))
+    return set(hypothesis)
 
 
 def pac_basis(formal_concept, closure_operator, membership_oracle,
-              epsilon=0.1, delta=0.1):
-    hypothesis = set()
+              epsilon=0.1, delta=0.1,
+              equivalence_oracle=oracle.approx_equivalent,
+              schedule='angluin', max_samples=None, max_seconds=None,
+              rng=None, membership_batch=None, cancel=None):
+    """Computes a PAC basis. Returns the hypothesis and an oracle.QueryStats
+    accounting for the queries and time spent.
+    `equivalence_oracle` has the signature of oracle.approx_equivalent and
+    must accept the `stats`, `schedule`, `budget` and `rng` keyword
+    arguments.
+    `schedule` is the sample schedule of the equivalence queries, see
+    oracle.sample_size. Once `max_samples` samples are drawn or
+    `max_seconds` have passed, the current hypothesis is returned and
+    stats.confidence tells the confidence achieved by its last query. So it
+    is once the Event `cancel` (e.g. a multiprocessing.Event) is set.
+    `rng` is a numpy Generator (see oracle.spawn_rngs) drawing every sample
+    of the run, which makes the run reproducible.
+    `membership_batch` (a list of sets => list of answers) asks the
+    membership queries of every update in one call, e.g. to a remote oracle
+    (see oracle_server.RemoteConcepts.member_batch).
+    """
+    hypothesis = imp.Hypothesis()
+    attributes = set(formal_concept.context.attributes)
+    stats = oracle.QueryStats()
+    budget = None
+    if max_samples is not None or max_seconds is not None or \
+            cancel is not None:
+        budget = {'samples': max_samples, 'deadline': None,
+                  'cancel': cancel}
+        if max_seconds is not None:
+            budget['deadline'] = time.time() + max_seconds
+
+    def counted_closure(s):
+        stats.closures += 1
+        return closure_operator(s)
+
+    def counted_member(s, closure_operator):
+        stats.membership_queries += 1
+        return membership_oracle(s, closure_operator)
+
+    counted_batch = None
+    if membership_batch is not None:
+        def counted_batch(sets):
+            stats.membership_queries += len(sets)
+            return membership_batch(sets)
+
     # NOTE: counter_example is a set
     i = 0  # number of queries
     spec = 0
     weak = 0
     no_resp = 0
-    t_spec = 0
-    t_weak = 0
-    t_no_resp = 0
     while True:
-        counter_example = oracle.approx_equivalent(
-            set(hypothesis), membership_oracle, formal_concept,
-            closure_operator, i,
-            {'no_resp': no_resp, 'spec': spec, 'weak': weak},
-            epsilon, delta)
+        stats.equivalence_queries += 1
+        with stats.phase('equivalence'):
+            counter_example = equivalence_oracle(
+                hypothesis, counted_member, formal_concept,
+                counted_closure, i,
+                {'no_resp': no_resp, 'spec': spec, 'weak': weak},
+                epsilon, delta, stats=stats, schedule=schedule,
+                budget=budget, rng=rng)
 
         if counter_example['value'] is None:
-            # TODO: Remove this
-            print('# equivalence queries: {0}, # disrespect trigger: {3},\
- # special trigger: {1}, # weak triggers: {2}'.format(
-                i, t_spec, t_weak, t_no_resp))
+            stats.exhausted = counter_example.get('exhausted', False)
+            stats.confidence = counter_example.get(
+                'confidence', 1 - oracle.query_delta(i, delta, schedule))
             break
 
-        if len(hypothesis) == 0:
-            hypothesis.add(imp.Implication(
-                counter_example['value'],
-                set(formal_concept.context.attributes)))
-            continue
-
-        i += 1
-        for implication in hypothesis.copy():
-            # if an implication doesn't repect the counter example,
-            # modify it's conclusion (also called strengthening)
-            if not implication.is_respected(counter_example['value']):
-                hypothesis.remove(implication)
-                hypothesis.add(imp.Implication(
-                    implication.premise,
-                    implication.conclusion.intersection(
-                        counter_example['value'])))
+        with stats.phase('update'):
+            if len(hypothesis) == 0:
+                hypothesis.add(imp.Implication(counter_example['value'],
+                                               attributes))
+                stats.hypothesis_sizes.append(len(hypothesis))
+                continue
+
+            i += 1
+            # if some implications don't repect the counter example, modify
+            # their conclusions (also called strengthening)
+            violated = hypothesis.violated_by(counter_example['value'])
+            for key in violated:
+                hypothesis.strengthen(key, counter_example['value'])
                 no_resp += 1
-                t_no_resp += 1
+                stats.triggers['no_resp'] += 1
                 weak = 0
                 spec = 0
-            else:
+            if not violated:
                 # special_implication (A --> B) is the first implication
                 # such that it's premise(A) is not a subset of
                 # counter_example(C) and member(C ∩ A) is false. The latter
                 # condition can also be interpreted as C ∩ A is not a model
                 # of context(K)
-                special_implication = imp.findSpecialImplication(
-                    hypothesis,
-                    membership_oracle,
-                    closure_operator,
-                    counter_example['value'])
-                if special_implication:
-                    hypothesis.remove(special_implication)
-                    hypothesis.add(imp.Implication(
-                        counter_example['value'].intersection(
-                            special_implication.premise),
-                        special_implication.conclusion.union(
-                            special_implication.premise.difference(
-                                counter_example['value']))))
+                special_key = hypothesis.special_implication(
+                    counter_example['value'], counted_member,
+                    counted_closure, counted_batch)
+                if special_key is not None:
+                    hypothesis.refine(special_key, counter_example['value'])
                     spec += 1
-                    t_spec += 1
+                    stats.triggers['spec'] += 1
                     no_resp = 0
                     weak = 0
                 else:
-                    hypothesis.add(imp.Implication(
-                        counter_example['value'],
-                        set(formal_concept.context.attributes)))
+                    hypothesis.add(imp.Implication(counter_example['value'],
+                                                   attributes))
                     weak += 1
-                    t_weak += 1
+                    stats.triggers['weak'] += 1
                     no_resp = 0
                     spec = 0
-    return hypothesis
+            stats.hypothesis_sizes.append(len(hypothesis))
+    return set(hypothesis), stats
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the PAC-learning pipeline.
+
+1. samplers - equivalence queries to convergence and wall time of pac_basis
+              for each counter-example sampler at a fixed epsilon/delta
+2. lcs      - helper.lcs against the former regex search on the
+              (source, target) pairs of a training file
+
+Usage: python benchmark.py samplers data/train/english-train-low
+       python benchmark.py lcs data/train/english-train-high
+"""
+
+import re
+import sys
+import time
+import functools
+import pandas as pd
+
+import helper
+import oracle
+import concept_context as cn
+
+SAMPLERS = [
+    ('uniform (default)', None),
+    ('uniform', oracle.uniform_sampler),
+    ('object intents', oracle.intent_sampler),
+    ('attribute frequency', oracle.frequency_sampler),
+    ('hypothesis-guided', oracle.hypothesis_sampler),
+]
+
+
+def load_relations(train_file):
+    """Builds the (operation, source word) relations of a training file"""
+    train_data = pd.read_csv(train_file, sep='\t', names=['source', 'target',
+                                                          'pos_info'])
+    train_data = helper.align_frame(train_data)
+    return helper.build_relations(train_data)
+
+
+def benchmark_samplers(relations, epsilon=0.1, delta=0.1, repeats=3,
+                       samplers=SAMPLERS):
+    """Learns a PAC basis `repeats` times per sampler. Returns a list of
+    (sampler name, mean # equivalence queries, mean # membership queries,
+    mean # samples, mean seconds, mean basis size)."""
+    concepts = cn.formalConcepts(relations)
+    concepts.computeLattice()
+    results = []
+    for name, sampler in samplers:
+        runs = []
+        # every sampler sees the same streams
+        for rng in oracle.spawn_rngs(0, repeats):
+            start = time.time()
+            concepts.computeCanonicalBasis(
+                epsilon=epsilon, delta=delta, basis_type='pac',
+                equivalence_oracle=functools.partial(
+                    oracle.approx_equivalent, sampler=sampler), rng=rng)
+            stats = concepts.pac_stats
+            runs.append((stats.equivalence_queries, stats.membership_queries,
+                         stats.samples, time.time() - start,
+                         len(concepts.canonical_basis)))
+        results.append((name,) + tuple(sum(run[k] for run in runs) /
+                                       float(repeats) for k in range(5)))
+    return results
+
+
+def regex_lcs(s1, s2):
+    """The former helper.lcs, which compiles a regex per candidate"""
+    longest = ""
+    i = 0
+    for x in s1:
+        if re.search(re.compile(re.escape(x)), s2):
+            s = x
+            while re.search(re.compile(re.escape(s)), s2):
+                if len(s) > len(longest):
+                    longest = s
+                if i+len(s) == len(s1):
+                    break
+                s = s1[i:i+len(s)+1]
+            i += 1
+    return longest
+
+
+def benchmark_lcs(train_file, repeats=3,
+                  implementations=(('regex', regex_lcs),
+                                   ('suffix automaton', helper.lcs))):
+    """Times every LCS implementation on the (source, target) pairs of a
+    training file. Returns a list of (implementation, # pairs, best
+    seconds of `repeats`, # results differing from the first
+    implementation)."""
+    train_data = pd.read_csv(train_file, sep='\t', names=['source', 'target',
+                                                          'pos_info'])
+    pairs = list(zip(train_data['source'], train_data['target']))
+    reference = None
+    results = []
+    for name, lcs in implementations:
+        best = None
+        for _ in range(repeats):
+            start = time.time()
+            found = [lcs(source, target) for source, target in pairs]
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        if reference is None:
+            reference = found
+        results.append((name, len(pairs), best,
+                        sum(a != b for a, b in zip(reference, found))))
+    return results
+
+
+def print_table(header, rows):
+    print(' | '.join(header))
+    for row in rows:
+        print(' | '.join(str(round(col, 3)) if isinstance(col, float)
+                         else str(col) for col in row))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('samplers', 'lcs'):
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == 'samplers':
+        print_table(('sampler', '# equivalence queries',
+                     '# membership queries', '# samples', 'seconds',
+                     '# implications'),
+                    benchmark_samplers(load_relations(sys.argv[2])))
+    else:
+        print_table(('implementation', '# pairs', 'seconds', '# mismatches'),
+                    benchmark_lcs(sys.argv[2]))
@@ -5,6 +5,8 @@ Derivation and closure operators"""
 
 import copy
 
+from implications import bitset_to_set
+
 
 def oprime(objects, context):
     """
@@ -150,6 +152,126 @@ def lin_closure(s, implications):
     return new_closure
 
 
+def next_closure(attributes, close):
+    """
+    Yields all the sets closed under `close` in the lectic order of
+    `attributes` (B. Ganter: Two basic algorithms in concept analysis, 1984)
+    """
+    a = set(close(set()))
+    yield set(a)
+    while len(a) < len(attributes):
+        for j in range(len(attributes) - 1, -1, -1):
+            m = attributes[j]
+            if m in a:
+                a.remove(m)
+            else:
+                b = set(close(a | set([m])))
+                if not (b - a) & set(attributes[:j]):
+                    a = b
+                    yield set(a)
+                    break
+        else:
+            return
+
+
+class CompiledClosure(object):
+    """
+    LinClosure compiled for a fixed list of implications.
+
+    Premises and conclusions are kept as attribute bitsets and every
+    attribute knows the implications whose premise contains it, so a
+    closure costs time linear in the size of the implications it fires.
+    Implications can be replaced or disabled in place, which is what
+    basis minimization needs.
+    """
+
+    def __init__(self, implications, attributes=None):
+        implications = list(implications)
+        if attributes is None:
+            attributes = []
+            seen = set()
+            for imp in implications:
+                for a in list(imp.premise) + list(imp.conclusion):
+                    if a not in seen:
+                        seen.add(a)
+                        attributes.append(a)
+        self.attributes = list(attributes)
+        self.bits = dict((a, 1 << i) for i, a in enumerate(self.attributes))
+        self.premises = []
+        self.conclusions = []
+        self.sizes = []
+        self.active = []
+        self.watch = [set() for a in self.attributes]
+        for imp in implications:
+            self.append(*imp.to_bitsets(self.bits))
+
+    def to_bitset(self, attributes):
+        bitset = 0
+        for a in attributes:
+            bitset |= self.bits[a]
+        return bitset
+
+    def from_bitset(self, bitset):
+        return bitset_to_set(bitset, self.attributes)
+
+    def replace(self, i, premise, conclusion):
+        """Replace the i-th implication by premise => conclusion (bitsets)"""
+        old = self.premises[i]
+        while old:
+            bit = old & -old
+            old ^= bit
+            self.watch[bit.bit_length() - 1].discard(i)
+        self.premises[i] = premise
+        self.conclusions[i] = conclusion | premise
+        self.sizes[i] = bin(premise).count('1')
+        self.active[i] = True
+        while premise:
+            bit = premise & -premise
+            premise ^= bit
+            self.watch[bit.bit_length() - 1].add(i)
+
+    def append(self, premise, conclusion):
+        """Add the implication premise => conclusion (bitsets)"""
+        self.premises.append(0)
+        self.conclusions.append(0)
+        self.sizes.append(0)
+        self.active.append(True)
+        self.replace(len(self.premises) - 1, premise, conclusion)
+
+    def disable(self, i):
+        self.active[i] = False
+
+    def closure_bitset(self, bitset):
+        """Return the closure of bitset w.r.t. the active implications"""
+        count = self.sizes[:]
+        new_closure = bitset
+        for i, size in enumerate(self.sizes):
+            if size == 0 and self.active[i]:
+                new_closure |= self.conclusions[i]
+        update = new_closure
+        while update:
+            bit = update & -update
+            update ^= bit
+            for i in self.watch[bit.bit_length() - 1]:
+                count[i] -= 1
+                if count[i] == 0 and self.active[i]:
+                    add = self.conclusions[i] & ~new_closure
+                    new_closure |= add
+                    update |= add
+        return new_closure
+
+    def __call__(self, s):
+        """Return the closure of the attribute set s"""
+        unknown = set(a for a in s if a not in self.bits)
+        known = self.to_bitset(a for a in s if a in self.bits)
+        return self.from_bitset(self.closure_bitset(known)) | unknown
+
+    def implications(self):
+        """Return the active implications as (premise, conclusion) bitsets"""
+        return [(self.premises[i], self.conclusions[i])
+                for i in range(len(self.premises)) if self.active[i]]
+
+
 def closure(current, base_set, implications, prefLen):
     """
     return the closure of attributes
@@ -20,8 +20,10 @@ import sys
 import gc
 import copy
 from functools import reduce
+import numpy as np
 
 import closure_operators
+import implications
 from implications import Implication
 import basis
 import oracle
@@ -154,6 +156,8 @@ class formalContext:
         # ordering of concepts.
         self.objects = []
         self.attributes = []
+        # map from attribute => weight, see fromCodes
+        self.attributeWeights = None
         if objects is not None:
             self.objects = list(objects)
             for obj in objects:
@@ -180,6 +184,54 @@ class formalContext:
         self.attributes.sort()
         self.attributes.reverse()
 
+    @classmethod
+    def fromCodes(cls, object_ids, attribute_ids, objects, attributes,
+                  weights=None):
+        """ Builds the context of the relation of (objects[object_ids[k]],
+        attributes[attribute_ids[k]]) pairs, see helper.relation_codes,
+        without going through a list of tuples. The objects and attributes
+        are ordered as if the pairs had been passed to the constructor.
+        With the weights of the pairs (those of the rows they come from),
+        every attribute weighs the mean weight of its pairs, i.e. the
+        multiplicity of its rows, see attributeFrequencies."""
+        context = cls([])
+        objects = np.asarray(objects).tolist()
+        attributes = np.asarray(attributes).tolist()
+        if len(object_ids) == 0:
+            return context
+        # one key per distinct pair, sorted by object then attribute
+        pairs = np.unique(np.asarray(object_ids, dtype=np.int64) *
+                          len(attributes) + attribute_ids)
+        pair_objects, pair_attributes = np.divmod(pairs, len(attributes))
+        starts = np.flatnonzero(np.diff(pair_objects)) + 1
+        for obj, atts in zip(pair_objects[np.r_[0, starts]].tolist(),
+                             np.split(pair_attributes, starts)):
+            context.objectsToAttributes[objects[obj]] = set(
+                attributes[att] for att in atts.tolist())
+        order = np.argsort(pair_attributes, kind='stable')
+        pair_objects, pair_attributes = (pair_objects[order],
+                                         pair_attributes[order])
+        starts = np.flatnonzero(np.diff(pair_attributes)) + 1
+        for att, objs in zip(pair_attributes[np.r_[0, starts]].tolist(),
+                             np.split(pair_objects, starts)):
+            context.attributesToObjects[attributes[att]] = set(
+                objects[obj] for obj in objs.tolist())
+        # codes are numbered by first appearance like the constructor does
+        context.objects = [obj for obj in objects
+                           if obj in context.objectsToAttributes]
+        context.attributes = [att for att in attributes
+                              if att in context.attributesToObjects]
+        context.attributes.sort()
+        context.attributes.reverse()
+        if weights is not None:
+            totals = np.bincount(attribute_ids, weights=weights,
+                                 minlength=len(attributes))
+            counts = np.bincount(attribute_ids, minlength=len(attributes))
+            context.attributeWeights = dict(
+                (att, total / count) for att, total, count in
+                zip(attributes, totals.tolist(), counts.tolist()) if count)
+        return context
+
     def objectsPrime(self, objectSet):
         """return a frozenset of all attributes which are shared by members of
         objectSet."""
@@ -221,6 +273,63 @@ class formalContext:
         ilist.sort()
         return ilist
 
+    def attributeBitset(self, attributeSet):
+        """return attributeSet as an int whose i-th bit stands for the i-th
+        attribute."""
+        if not hasattr(self, '_attributeBits'):
+            self._attributeBits = dict(
+                (att, 1 << i) for i, att in enumerate(self.attributes))
+        bitset = 0
+        for att in attributeSet:
+            bitset |= self._attributeBits[att]
+        return bitset
+
+    def bitsetAttributes(self, bitset):
+        """return the set of attributes encoded by bitset."""
+        attributeSet = set()
+        i = 0
+        while bitset:
+            if bitset & 1:
+                attributeSet.add(self.attributes[i])
+            bitset >>= 1
+            i += 1
+        return attributeSet
+
+    def incidenceMatrix(self):
+        """return the cross table as a boolean numpy array with a row per
+        object and a column per attribute, in the order of self.objects and
+        self.attributes."""
+        if not hasattr(self, '_incidence'):
+            self._incidence = implications.sets_matrix(
+                [self.objectsToAttributes[obj] for obj in self.objects],
+                self.attributes)
+        return self._incidence
+
+    def attributeFrequencies(self):
+        """return a dict attribute => share |m'| / |G| of the objects having
+        it. With attributeWeights, the share of m is scaled by the weight of
+        m over the mean weight (capped at 1), so unit weights give |m'| / |G|
+        exactly and repeated rows make their source words more frequent."""
+        if getattr(self, '_frequencies', None) is None:
+            size = float(len(self.objects))
+            self._frequencies = dict(
+                (att, len(self.attributesToObjects[att]) / size)
+                for att in self.attributes)
+            weights = getattr(self, 'attributeWeights', None)
+            if weights:
+                mean = sum(weights[att] for att in self.attributes) / \
+                    len(self.attributes)
+                for att in self.attributes:
+                    self._frequencies[att] = min(
+                        1., self._frequencies[att] * (weights[att] / mean))
+        return self._frequencies
+
+    def objectBitsets(self):
+        """return list of the object intents as attribute bitsets, in the
+        order of self.objects."""
+        return [self.attributeBitset(self.objectsToAttributes[obj])
+                for obj in self.objects]
+
 
 class formalConcepts:
     """ Computes set of concepts from a binary relation by an algorithm similar
@@ -235,6 +344,17 @@ class formalConcepts:
         self.intentToConceptDict = dict()
         self.extentToConceptDict = dict()
 
+    @classmethod
+    def fromCodes(cls, object_ids, attribute_ids, objects, attributes,
+                  weights=None):
+        """ Same as the constructor, from the integer coded relation of
+        helper.relation_codes, see formalContext.fromCodes."""
+        concepts = cls([])
+        concepts.context = formalContext.fromCodes(object_ids, attribute_ids,
+                                                   objects, attributes,
+                                                   weights)
+        return concepts
+
     def computeUpperNeighbours(self, concept):
         """ This version of upperNeighbours runs fast enough in Python to be useful.
         Based on a theorem from C. Lindig's (1999) PhD thesis.
@@ -392,31 +512,49 @@ class formalConcepts:
 
     def computeCanonicalBasis(self, close=closure_operators.lin_closure,
                               imp_basis=[], epsilon=0.1, delta=0.1,
-                              basis_type=None):
+                              basis_type=None, workers=None,
+                              equivalence_oracle=None,
+                              membership_oracle=oracle.member,
+                              schedule='angluin', max_samples=None,
+                              max_seconds=None, rng=None, cancel=None):
         """Computes Duquenne-Guigues basis for the context using
-        optimized Ganter algorithm"""
+        optimized Ganter algorithm. If `workers` is given, the exact basis is
+        computed on that many processes instead. `equivalence_oracle` and
+        `membership_oracle` replace the default oracles of the 'horn1' and
+        'pac' basis types, e.g. by an oracle.MembershipCache. `schedule`,
+        `max_samples`, `max_seconds`, `rng` and `cancel` are passed on to
+        basis.pac_basis."""
         def aclose(attributes): return closure_operators.aclosure(attributes,
                                                                   self.context)
         # Computes canonical basis using Ganter's algorithm. Doesn't involve
         # oracles
-        if not basis_type:
+        if not basis_type and workers:
+            self.canonical_basis = basis.parallelComputeDgBasis(
+                self.context, imp_basis=imp_basis, cond=lambda x: True,
+                workers=workers)
+        elif not basis_type:
             self.canonical_basis = basis.generalizedComputeDgBasis(
                 self.context.attributes, aclose,
                 imp_basis=imp_basis, cond=lambda x: True)
         elif basis_type == 'horn1':
             # Computes canonical basis using horn1 algorithm. Involves member? and
-            # equivalent? oracles
+            # equivalent? oracles, the latter is exact by default
             self.canonical_basis = basis.horn1(self,
                                                aclose,
-                                               oracle.member,
-                                               oracle.equivalent)
+                                               membership_oracle,
+                                               equivalence_oracle or
+                                               oracle.exact_equivalent)
+        elif basis_type in ('proper_premises', 'direct'):
+            # Computes an iteration-free basis from the proper premises
+            self.canonical_basis = basis.computeDirectBasis(self.context,
+                                                            basis_type)
         elif basis_type == 'pac':
             # Computes pac-basis
-            self.canonical_basis = basis.pac_basis(self,
-                                                   aclose,
-                                                   oracle.member,
-                                                   epsilon,
-                                                   delta)
+            # self.pac_stats accounts for the queries of the run
+            self.canonical_basis, self.pac_stats = basis.pac_basis(
+                self, aclose, membership_oracle, epsilon, delta,
+                equivalence_oracle or oracle.approx_equivalent,
+                schedule, max_samples, max_seconds, rng, cancel=cancel)
         print("Done computing canonical basis")
 
     def computeMinExtentLattice(self, minextent=0):
@@ -940,8 +1078,8 @@ class formalConcepts:
 
         for con in self.concepts:
             ccopy = con.copy()
-            unn = map(lambda x: x.cnum, ccopy.upperNeighbours)
-            lnn = map(lambda x: x.cnum, ccopy.lowerNeighbours)
+            unn = [x.cnum for x in ccopy.upperNeighbours]
+            lnn = [x.cnum for x in ccopy.lowerNeighbours]
             ccopy.upperNeighbours = unn
             ccopy.lowerNeighbours = lnn
             dictcopy["concepts"] += [ccopy]
@@ -963,8 +1101,8 @@ class formalConcepts:
             cnumToRefs[con.cnum] = con
 
         for con in thedict["concepts"]:
-            unn = map(lambda x: cnumToRefs[x], con.upperNeighbours)
-            lnn = map(lambda x: cnumToRefs[x], con.lowerNeighbours)
+            unn = [cnumToRefs[x] for x in con.upperNeighbours]
+            lnn = [cnumToRefs[x] for x in con.lowerNeighbours]
             con.upperNeighbours = unn
             con.lowerNeighbours = lnn
         self.__dict__ = thedict
@@ -9,87 +9,123 @@ Evaluation approach currently used in the script:
 
 import os
 import copy
+import time
+import functools
+import traceback
+import multiprocessing
 import helper
+import implications
+import preprocess
+import oracle
 import operator
 import pandas as pd
 import concept_context as cn
+from concurrent import futures
 
 TRAIN_DIR = 'data/train/'
 DEV_DIR = 'data/dev/'
 COV_TEST_DIR = 'data/test/covered/'
 UNCOV_TEST_DIR = 'data/test/uncovered/'
+ALIGNMENT_CACHE = 'data/out/alignments.db'
+PREPROCESSED_DIR = 'data/out/preprocessed/'
 
 
-def evaluate(train_dir, test_dir, filter_pac=True):
+def evaluate(train_dir, test_dir, filter_pac=True,
+             membership_oracle=oracle.member, rng=None):
     """
     Parameters:
     -----------------
     train_dir (Str): Path to the training file
     test_dir (Str): Path to the testing file
+    membership_oracle: Oracle used for PAC learning, pass the same
+                       oracle.MembershipCache to runs on the same file
+    rng: numpy Generator drawing the samples of the PAC run
     """
-
-    # Load training and testing data into a dataframe
-    train_data = pd.read_csv(train_dir, sep='\t', names=['source', 'target',
-                                                         'pos_info'])
-    uniq_rows = []
-    for src in train_data['source'].unique():
-        try:
-            uniq_rows.append(train_data[train_data['source'] == src].iloc[0])
-        except IndexError:
-            continue
-    train_data = pd.DataFrame.from_records(uniq_rows)
+    data = load(train_dir, test_dir)
+    if data is None:
+        return(0, {})
+    return learn_and_score(data, filter_pac, membership_oracle, rng)[:2]
+
+
+def load(train_dir, test_dir, alignment_cache=ALIGNMENT_CACHE,
+         store=PREPROCESSED_DIR):
+    """Loads the training and testing files and builds the concept lattice
+    of the training data, the alignments are looked up in the
+    helper.AlignmentCache at alignment_cache (if not None) and the
+    preprocessed training file in store (if not None, see
+    preprocess.LanguageData.from_store). Returns
+    (train_data, test_data, attribute_size, concepts), or None if no test
+    word is in the training data. Runs of learn_and_score only replace
+    concepts.canonical_basis, so they can share the result."""
+    # Load the preprocessed training data and the testing data
+    cache = None
+    if alignment_cache:
+        cache = helper.AlignmentCache(alignment_cache)
+    language = preprocess.LanguageData.from_store(train_dir, store, cache)
+    if cache is not None:
+        cache.close()
+    train_data, relation = language.first_by_source()
     test_data = pd.read_csv(test_dir, sep='\t', names=['source', 'target',
                                                        'pos_info'])
 
-    attribute_size = train_data['source'].size
+    # number of attributes (distinct source words) of the context, rows
+    # are deduplicated into weighted ones
+    attribute_size = train_data['source'].nunique()
 
-    test_data = pd.merge(train_data, test_data, how='inner', on=['source',
-                                                                 'target'])
+    test_data = pd.merge(train_data[list(preprocess.TEXT_COLUMNS)], test_data,
+                         how='inner', on=['source', 'target'])
     test_data.dropna(inplace=True)
     common_words = test_data['source']
 
     if len(common_words) == 0:
-        return(0, {})
-
-    # process training data
-    train_data = train_data.apply(helper.iterLCS, axis=1)
-
-    relations = build_relations(train_data)
+        return None
 
     # Build the concept lattice
-    concepts = cn.formalConcepts(relations)
+    concepts = cn.formalConcepts.fromCodes(*relation)
     concepts.computeLattice()
+    return train_data, test_data, attribute_size, concepts
+
+
+def learn_and_score(data, filter_pac=True, membership_oracle=oracle.member,
+                    rng=None, max_seconds=None, cancel=None):
+    """Learns a PAC basis from data (see load) and applies it to the test
+    words, learning stops once the Event cancel is set. Returns (accuracy,
+    word map, oracle.QueryStats of the run)."""
+    train_data, test_data, attribute_size, concepts = data
+    common_words = test_data['source']
 
     # Find canonical basis
-    concepts.computeCanonicalBasis(epsilon=0.1, delta=0.1, basis_type='pac')
+    concepts.computeCanonicalBasis(epsilon=0.1, delta=0.1, basis_type='pac',
+                                   membership_oracle=membership_oracle,
+                                   rng=rng, max_seconds=max_seconds,
+                                   cancel=cancel)
 
     print("Total implications: {}\n".format(len(concepts.canonical_basis)))
 
     unique_conclusions = []
-    for impl in copy.deepcopy(concepts.canonical_basis):
+    filtered_basis = []
+    for impl in concepts.canonical_basis:
+        unique_conclusions.append(frozenset(impl.conclusion))
         if len(impl.premise) == 0:
-            concepts.canonical_basis.remove(impl)
+            continue
         if filter_pac:
             # Remove implications of the form C --> M and C --> C
             if impl.premise == impl.conclusion or len(impl.conclusion) == attribute_size:
-                concepts.canonical_basis.remove(impl)
-        unique_conclusions.append(frozenset(impl.conclusion))
+                continue
+        filtered_basis.append(impl)
 
     print("Total UNIQUE conclusions: {}\n".format(len(set(unique_conclusions))))
-    concepts.canonical_basis = set(
-        sorted(
-            list(
-                concepts.canonical_basis),
-            reverse=True))
-
-    implId_opnSeq_map = {}
-    for idx, impl in enumerate(concepts.canonical_basis):
-        premise = train_data['source'].isin(impl.premise)
-        premise_data = train_data[premise]
-        implId_opnSeq_map[idx] = operation(premise_data)
+    # a list, so that the operation map and the matching below see the
+    # implications in the same, reproducible order
+    concepts.canonical_basis = implications.sort_basis(filtered_basis)
+
+    # most common operation sequence of the premise rows of every implication
+    implId_opnSeq_map = dict(enumerate(helper.operations(
+        concepts.canonical_basis, train_data)))
 
     word_map = {}
     correct = 0
+    matches = []
     for word in common_words:
         # gt => Ground Truth
         word_map[word] = {
@@ -97,74 +133,136 @@ def evaluate(train_dir, test_dir, filter_pac=True):
         for idx, impl in enumerate(concepts.canonical_basis):
             # use conclusion as it contains elements of premise too
             if word in impl.conclusion:
-                opn_seq = implId_opnSeq_map[idx].split(' ')
-                output = apply_operation(opn_seq, word)
-                word_map[word]['pac_output'] = output
-                if word_map[word]['gt'] == output:
-                    correct += 1
+                matches.append((word, idx))
                 # stop at the first match as basis is sorted by premise length
                 break
+    outputs = helper.apply_operations(
+        [implId_opnSeq_map[idx] for word, idx in matches],
+        [word for word, idx in matches])
+    for (word, idx), output in zip(matches, outputs):
+        word_map[word]['pac_output'] = output
+        if word_map[word]['gt'] == output:
+            correct += 1
     accuracy = correct / float(len(common_words))
-    return(accuracy, word_map)
+    return(accuracy, word_map, concepts.pac_stats)
 
 
-def operation(dataframe):
-    """Returns the operation sequence most common in the dataframe"""
-    counter = {}
-    for i, r in dataframe.iterrows():
-        opn_seq = ' '.join(r['deleted'] + r['added'])
-        try:
-            counter[opn_seq] += 1
-        except KeyError:
-            counter[opn_seq] = 1
-    return max(counter.items(), key=operator.itemgetter(1))[0]
-
-
-def apply_operation(operation_sequence, word):
-    """Applies operation sequence on the word"""
-    for opn in operation_sequence:
-        if opn.startswith('::'):
-            # delete operation
-            opn = opn[2:]
-            if opn == '':
-                continue
-            else:
-                word = delete(opn, word)
-        else:
-            # insert operation
-            word = insert(opn, word)
-    return word
+_worker_data = None
+_worker_oracle = None
+_worker_cancel = None
 
 
-def delete(old, word, new='', occurrence=1):
-    """Removes to_delete from the word"""
-    li = word.rsplit(old, occurrence)
-    return(new.join(li))
+def _init_eval_worker(data, cancel=None):
+    """Receives the data of a language and the Event cancelling the runs
+    once per worker process"""
+    global _worker_data, _worker_oracle, _worker_cancel
+    _worker_data = data
+    _worker_oracle = oracle.MembershipCache()
+    _worker_cancel = cancel
 
 
-def insert(to_insert, word):
-    """Appends to_insert to the word"""
-    return(word + to_insert)
+def _eval_run(filter_pac, rng, deadline):
+    """Returns (accuracy, word map, stats, seconds) of a run, None if the
+    runs were cancelled before it started"""
+    if _worker_cancel is not None and _worker_cancel.is_set():
+        # prefetched by the pool, cancel_futures could not drop it
+        return None
+    max_seconds = None
+    if deadline is not None:
+        max_seconds = max(deadline - time.time(), 0)
+    start = time.time()
+    accuracy, word_map, stats = learn_and_score(
+        _worker_data, filter_pac, _worker_oracle, rng, max_seconds,
+        _worker_cancel)
+    return accuracy, word_map, stats, time.time() - start
 
 
-def build_relations(data):
+def best_of_runs(train_dir, test_dir, filter_pac=True, best_of=1, seed=None,
+                 workers=None, target_accuracy=None, max_seconds=None):
     """
-    Build attribute -- object (source-word -- operation) relations from processed training data
-    denote ::operation for delete operations. For eg. ::ना shows delete ना
+    Runs best_of randomized PAC evaluations of one language, on `workers`
+    processes if given, and returns the best (accuracy, word map) along
+    with a list of per-run reports (run number, accuracy, seconds and the
+    QueryStats of the run as a dict, the traceback of a failed run, or
+    'cancelled' for a run stopped before its first query completed).
+    Runs draw from independent streams spawned from seed. Once a run
+    reaches target_accuracy, or max_seconds have passed, the runs not
+    started yet are cancelled and the running ones stop learning, keeping
+    the hypothesis they have. A failed run does not stop the others.
     """
-    relations = []
-    data['deleted'] = data['deleted'].apply(
-        lambda opns: ['::' + opn for opn in opns])
-    for i, r in data.iterrows():
-        attr = r['source']
-        objects = r['deleted'] + r['added']
-        for obj in objects:
-            relations.append((obj, attr))
-    return relations
+    data = load(train_dir, test_dir)
+    if data is None:
+        return (0, {}), []
+    deadline = None
+    if max_seconds is not None:
+        deadline = time.time() + max_seconds
+    results = []
+    runs = []
+
+    def collect(run, future):
+        """Reports the run of future (a callable returning the result of
+        _eval_run), returns whether the remaining runs can be cancelled"""
+        try:
+            result = future()
+        except Exception:
+            runs.append({'run': run, 'error': traceback.format_exc()})
+            print("Run {} failed:\n{}".format(run, runs[-1]['error']))
+            return False
+        if result is None or (result[2].exhausted and
+                              not result[2].hypothesis_sizes):
+            # stopped before its first query completed, nothing was learned
+            runs.append({'run': run, 'cancelled': True})
+            return False
+        accuracy, word_map, stats, seconds = result
+        results.append((accuracy, word_map))
+        report = stats.to_dict()
+        report.update({'run': run, 'accuracy': accuracy, 'seconds': seconds})
+        runs.append(report)
+        return ((target_accuracy is not None and accuracy >= target_accuracy)
+                or (deadline is not None and time.time() >= deadline))
+
+    rngs = oracle.spawn_rngs(seed, best_of)
+    if not workers:
+        _init_eval_worker(data)
+        for run, rng in enumerate(rngs):
+            if collect(run, functools.partial(_eval_run, filter_pac, rng,
+                                              deadline)):
+                break
+    else:
+        # set once the remaining runs can be cancelled, the running ones
+        # poll it between samples (see oracle.samples_left)
+        cancel = multiprocessing.Event()
+        executor = futures.ProcessPoolExecutor(
+            workers, initializer=_init_eval_worker, initargs=(data, cancel))
+        try:
+            pending = dict((executor.submit(_eval_run, filter_pac, rng,
+                                            deadline), run)
+                           for run, rng in enumerate(rngs))
+            for future in futures.as_completed(pending):
+                done = pending.pop(future)
+                if collect(done, future.result):
+                    break
+        finally:
+            cancel.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+        # report the runs that were already running too
+        for future, run in pending.items():
+            if not future.cancelled():
+                collect(run, future.result)
+    runs.sort(key=operator.itemgetter('run'))
+    if not results:
+        return (0, {}), runs
+    return max(results, key=operator.itemgetter(0)), runs
 
 
 def complete_evaluation(training_files, method='uncov_test', level='medium',
-                        filter_pac=True, best_of=1):
+                        filter_pac=True, best_of=1, seed=None, workers=None,
+                        target_accuracy=None, max_seconds=None):
+    """best_of runs per language draw from independent streams spawned from
+    seed, the same seed reproduces the evaluation (no seed draws fresh
+    entropy). See best_of_runs for
+    workers, target_accuracy and max_seconds (per language). Returns the
+    best (accuracy, word map) and the per-run reports of every language."""
     if method == 'uncov_test':
         testing_files = os.listdir(UNCOV_TEST_DIR)
     elif method == 'dev':
@@ -180,21 +278,20 @@ def complete_evaluation(training_files, method='uncov_test', level='medium',
     # sort the list so that trainig and testing files are aligned
 
     acc_wrdMap = {}
+    run_stats = {}
     for idx, train_file in enumerate(training_files):
         lang = train_file.split('/')[-1]
-        for i in range(best_of):
-            try:
-                acc_wrdMap[lang].append(evaluate(
-                    TRAIN_DIR + train_file,
-                    UNCOV_TEST_DIR + testing_files[idx],
-                    filter_pac))
-            except KeyError:
-                acc_wrdMap[lang] = evaluate(
-                TRAIN_DIR + train_file,
-                UNCOV_TEST_DIR + testing_files[idx],
-                filter_pac)
-        acc_wrdMap[lang] = max(acc_wrdMap[lang], key=operator.itemgetter(0))
-        print("Language: {}, Accuracy: {}%".format(lang, acc_wrdMap[lang][0] * 100))
+        # runs of a process learn from the same context, so they share the
+        # membership answers
+        acc_wrdMap[lang], run_stats[lang] = best_of_runs(
+            TRAIN_DIR + train_file,
+            UNCOV_TEST_DIR + testing_files[idx],
+            filter_pac, best_of, None if seed is None else [seed, idx],
+            workers,
+            target_accuracy, max_seconds)
+        print("Language: {}, Accuracy: {}% ({} runs)".format(
+            lang, acc_wrdMap[lang][0] * 100, len(run_stats[lang])))
+    return acc_wrdMap, run_stats
 
 
 if __name__ == '__main__':
@@ -5,62 +5,248 @@ Author: Gaurav Sahu, 23:20 15th January, 2018
 Implements some helper methods used in the module.
 """
 
-import re
+import os
+import json
 import string
+import sqlite3
+import hashlib
 import operator
+import functools
+import collections
+import multiprocessing
 from itertools import chain, combinations
 
+import numpy as np
+import pandas as pd
+
+ALIGNMENT_COLUMNS = ('common', 'deleted', 'added')
+# part of the AlignmentCache keys, bump it when align changes its output
+ALIGNMENT_VERSION = 1
+
+
+def suffix_automaton(s):
+    """
+    Suffix automaton of s (A. Blumer et al.: The smallest automaton
+    recognizing the subwords of a text, 1985). Returns the transitions (a
+    dict per state), suffix links and lengths of the states; state 0 is the
+    initial state. Built in time linear in len(s).
+    """
+    transitions, links, lengths = [{}], [-1], [0]
+    last = 0
+    for x in s:
+        current = len(lengths)
+        transitions.append({})
+        links.append(0)
+        lengths.append(lengths[last] + 1)
+        p = last
+        while p != -1 and x not in transitions[p]:
+            transitions[p][x] = current
+            p = links[p]
+        if p != -1:
+            q = transitions[p][x]
+            if lengths[p] + 1 == lengths[q]:
+                links[current] = q
+            else:
+                clone = len(lengths)
+                transitions.append(dict(transitions[q]))
+                links.append(links[q])
+                lengths.append(lengths[p] + 1)
+                while p != -1 and transitions[p].get(x) == q:
+                    transitions[p][x] = clone
+                    p = links[p]
+                links[q] = clone
+                links[current] = clone
+        last = current
+    return transitions, links, lengths
+
+
+def matching_statistics(s1, s2):
+    """
+    ms[t] is the length of the longest prefix of s1[t:] occurring in s2.
+    Computed in linear time by running the reverse of s1 through the suffix
+    automaton of the reverse of s2.
+    """
+    transitions, links, lengths = suffix_automaton(s2[::-1])
+    ms = [0] * len(s1)
+    state, length = 0, 0
+    for t in range(len(s1) - 1, -1, -1):
+        x = s1[t]
+        while state and x not in transitions[state]:
+            state = links[state]
+            length = lengths[state]
+        if x in transitions[state]:
+            state = transitions[state][x]
+            length += 1
+        ms[t] = length
+    return ms
+
 
 def lcs(s1, s2):
     """
     Iterative longest continuous sequence. No one character matchings
     Inputs: string 1 (s1) and string 2 (s2)
     Output: lcs
+
+    Linear time, with the ties broken as by the former quadratic search:
+    it only tried the substrings starting at the first T positions of s1,
+    T being the number of characters of s1 found in s2, and kept the first
+    longest. Without a common substring of two characters, the first
+    character of s1 found in s2 is returned.
     """
-    longest = ""
-    i = 0
-    for x in s1:
-        # Use re.escape to avoid errors if while cards are present in the query
-        if re.search(re.compile(re.escape(x)), s2):
-            s = x
-            while re.search(re.compile(re.escape(s)), s2):
-                if len(s) > len(longest):
-                    longest = s
-                if i+len(s) == len(s1):
-                    break
-                s = s1[i:i+len(s)+1]
-            i += 1
-    return longest
+    present = set(s2)
+    found = sum(1 for x in s1 if x in present)
+    if not found:
+        return ""
+    ms = matching_statistics(s1, s2)
+    start = max(range(found), key=ms.__getitem__)
+    if ms[start] >= 2:
+        return s1[start:start + ms[start]]
+    return next(x for x in s1 if x in present)
 
 
-def iterLCS(pdf):
+def align(source, target):
     """
-    Input: pdf (pandas dataframe) having 'source' and 'target' columns
+    Splits source and target into their common substrings (the longest
+    first, see lcs), the parts left of source (deleted) and the parts left
+    of target (added). Returns the three lists; an empty deleted or added
+    list is [''].
     """
-    sw1 = pdf['source']
-    sw2 = pdf['target']
     longList = []
     while True:
-        tempVal = lcs(sw1, sw2)
+        tempVal = lcs(source, target)
         if len(tempVal) <= 1:
             break
 
         longList.append(tempVal)
-        sw1 = sw1.replace(tempVal, '#', 1)
-        sw2 = sw2.replace(tempVal, '!', 1)
-    pdf['common'] = longList
-    pdf['deleted'] = [item for item in sw1.split('#') if len(item) > 0]
+        source = source.replace(tempVal, '#', 1)
+        target = target.replace(tempVal, '!', 1)
+    deleted = [item for item in source.split('#') if len(item) > 0]
+    added = [item for item in target.split('!') if len(item) > 0]
+    return longList, deleted or [''], added or ['']
 
-    if len(pdf['deleted']) == 0:
-        pdf['deleted'] = ['']
 
-    pdf['added'] = [item for item in sw2.split('!') if len(item) > 0]
-
-    if len(pdf['added']) == 0:
-        pdf['added'] = ['']
+def iterLCS(pdf):
+    """
+    Input: pdf (pandas dataframe) having 'source' and 'target' columns
+    """
+    pdf['common'], pdf['deleted'], pdf['added'] = align(pdf['source'],
+                                                        pdf['target'])
     return pdf
 
 
+def _align_chunk(pairs):
+    """Aligns a list of (source, target) pairs"""
+    return [align(source, target) for source, target in pairs]
+
+
+class AlignmentCache(object):
+    """
+    Alignments (see align) stored on disk in an SQLite table keyed by a
+    hash of the (source, target) pair, so that pipeline runs only align the
+    pairs no earlier run has seen. Bump ALIGNMENT_VERSION whenever align
+    changes its output.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS alignments '
+                                '(key BLOB PRIMARY KEY, alignment TEXT)')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source, target):
+        return hashlib.sha1(u'{}\t{}\t{}'.format(
+            ALIGNMENT_VERSION, source, target).encode('utf-8')).digest()
+
+    def lookup(self, pairs):
+        """Returns a dict (source, target) => alignment of the pairs found"""
+        keys = dict((self.key(*pair), pair) for pair in pairs)
+        key_list = list(keys)
+        found = {}
+        for k in range(0, len(key_list), 500):
+            chunk = key_list[k:k + 500]
+            rows = self.connection.execute(
+                'SELECT key, alignment FROM alignments WHERE key IN ({})'
+                .format(','.join('?' * len(chunk))), chunk)
+            for key, alignment in rows:
+                found[keys[bytes(key)]] = tuple(json.loads(alignment))
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def insert(self, alignments):
+        """Stores a dict (source, target) => alignment"""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO alignments VALUES (?, ?)',
+                ((self.key(*pair), json.dumps(alignment, ensure_ascii=False))
+                 for pair, alignment in alignments.items()))
+
+    def close(self):
+        self.connection.close()
+
+
+def batch_align(sources, targets, workers=None, chunksize=2048, cache=None):
+    """
+    Aligns every source with its target (see align). Returns a dict mapping
+    'common', 'deleted' and 'added' to (offsets, values), numpy arrays such
+    that the parts of row i are values[offsets[i]:offsets[i + 1]].
+    Every distinct pair is aligned once, and only if it is not in the
+    AlignmentCache `cache`. With `workers`, chunks of `chunksize` pairs are
+    aligned on a process pool.
+    """
+    pairs = list(zip(sources, targets))
+    unique = list(dict.fromkeys(pairs))
+    aligned = cache.lookup(unique) if cache is not None else {}
+    missing = [pair for pair in unique if pair not in aligned]
+    chunks = [missing[k:k + chunksize]
+              for k in range(0, len(missing), chunksize)]
+    if workers and len(chunks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_align_chunk, chunks)
+    else:
+        results = [_align_chunk(chunk) for chunk in chunks]
+    new = dict(zip(missing, chain.from_iterable(results)))
+    if cache is not None and new:
+        cache.insert(new)
+    aligned.update(new)
+
+    alignment = {}
+    for column, name in enumerate(ALIGNMENT_COLUMNS):
+        counts = [len(aligned[pair][column]) for pair in pairs]
+        values = [value for pair in pairs for value in aligned[pair][column]]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        alignment[name] = (offsets, np.array(values, dtype=str))
+    return alignment
+
+
+def column_lists(offsets, values):
+    """Returns the rows of a columnar array (see batch_align) as lists"""
+    values = values.tolist()
+    return [values[start:end]
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def align_frame(data, workers=None, cache=None):
+    """
+    Same result as data.apply(iterLCS, axis=1), from a single batch_align
+    call instead of one pandas Series per row.
+    """
+    alignment = batch_align(data['source'].tolist(), data['target'].tolist(),
+                            workers, cache=cache)
+    data = data.copy()
+    for name in ALIGNMENT_COLUMNS:
+        data[name] = pd.Series(column_lists(*alignment[name]),
+                               index=data.index, dtype=object)
+    return data
+
+
 def powerset(iterable):
     """
     Taken from itertools recipes -->
@@ -70,49 +256,222 @@ def powerset(iterable):
     return chain.from_iterable(combinations(s, r) for r in range(1, len(s)+1))
 
 
+def columnar(column):
+    """Returns a column of lists as (offsets, values), see batch_align"""
+    counts = np.fromiter((len(parts) for parts in column), dtype=np.int64,
+                         count=len(column))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, np.array(list(chain.from_iterable(column)), dtype=str)
+
+
+def relation_codes(data):
+    """
+    Columnar build_relations: the attribute -- object (source-word --
+    operation) relation of processed training data, as integer codes.
+    Like build_relations, marks the deletions in data['deleted'] with '::'.
+    Returns (object_ids, attribute_ids, objects, attributes, weights), numpy
+    arrays such that the k-th pair of the relation is
+    (objects[object_ids[k]], attributes[attribute_ids[k]]), in the order
+    build_relations emits them, and comes from rows of data['weight']
+    weights[k] (1 without a weight column, see preprocess.deduplicate).
+    Objects and attributes are numbered in order of first appearance. See
+    formalContext.fromCodes.
+    """
+    deleted_offsets, deleted = columnar(data['deleted'])
+    deleted = np.char.add('::', deleted)
+    data['deleted'] = pd.Series(column_lists(deleted_offsets, deleted),
+                                index=data.index, dtype=object)
+    added_offsets, added = columnar(data['added'])
+    rows = np.arange(len(data))
+    pair_rows = np.concatenate([np.repeat(rows, np.diff(deleted_offsets)),
+                                np.repeat(rows, np.diff(added_offsets))])
+    # the deleted parts of a row come before the added ones
+    order = np.argsort(pair_rows, kind='stable')
+    object_ids, objects = pd.factorize(
+        np.concatenate([deleted, added])[order])
+    source_ids, attributes = pd.factorize(
+        np.array(data['source'].tolist(), dtype=str))
+    return (object_ids, source_ids[pair_rows[order]],
+            np.asarray(objects, dtype=str), np.asarray(attributes, dtype=str),
+            row_weights(data)[pair_rows[order]])
+
+
+def row_weights(data):
+    """Returns the weight column of data (see preprocess.deduplicate) as a
+    float array, all ones if there is none"""
+    if 'weight' in data:
+        return data['weight'].to_numpy(dtype=np.float64)
+    return np.ones(len(data))
+
+
 def build_relations(data):
     """
     Build attribute -- object (source-word -- operation) relations from
     processed training data denote ::operation for delete operations.
     For eg. ::ना shows delete ना
     """
-    relations = []
-    data['deleted'] = data['deleted'].apply(
-        lambda opns: ['::' + opn for opn in opns])
-    for i, r in data.iterrows():
-        attr = r['source']
-        objects = r['deleted'] + r['added']
-        for obj in objects:
-            relations.append((obj, attr))
-    return relations
+    object_ids, attribute_ids, objects, attributes, weights = \
+        relation_codes(data)
+    return list(zip(objects[object_ids].tolist(),
+                    attributes[attribute_ids].tolist()))
 
 
 def operation(dataframe):
-    """Returns the most common operation sequence in the dataframe"""
+    """Returns the most common operation sequence in the dataframe, rows
+    counting as many times as their weight (see preprocess.deduplicate)"""
     counter = {}
     for i, r in dataframe.iterrows():
         opn_seq = ' '.join(r['deleted'] + r['added'])
+        weight = r['weight'] if 'weight' in r else 1
         try:
-            counter[opn_seq] += 1
+            counter[opn_seq] += weight
         except KeyError:
-            counter[opn_seq] = 1
+            counter[opn_seq] = weight
     return max(counter.items(), key=operator.itemgetter(1))[0]
 
 
+def operation_codes(data):
+    """Codes the operation sequence of every row of processed training data.
+    Returns (codes, sequences), row i having the sequence sequences[codes[i]]
+    """
+    codes, sequences = pd.factorize(np.array(
+        [' '.join(deleted + added)
+         for deleted, added in zip(data['deleted'], data['added'])],
+        dtype=object))
+    return codes, list(sequences)
+
+
+def word_rows(sources):
+    """Inverted index of a column of source words. Returns (words, offsets,
+    rows), the rows of words[k] being rows[offsets[k]:offsets[k + 1]] in
+    increasing order"""
+    word_ids, words = pd.factorize(np.array(list(sources), dtype=object))
+    rows = np.argsort(word_ids, kind='stable')
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(word_ids, minlength=len(words)), out=offsets[1:])
+    return list(words), offsets, rows
+
+
+def operations(implications, data):
+    """
+    Bulk operation: for every implication, the most common operation
+    sequence of the rows of data whose source is in its premise, i.e.
+    operation(data[data['source'].isin(impl.premise)]) with the same ties
+    (the sequence of the earliest row wins) and row weights. The counts of
+    all the implications are taken at once from (implication, sequence)
+    codes.
+    Returns a list aligned with implications, None where no row matches.
+    """
+    words, offsets, rows = word_rows(data['source'])
+    word_index = dict((word, k) for k, word in enumerate(words))
+    codes, sequences = operation_codes(data)
+    implication_ids = []
+    premise_rows = []
+    for i, impl in enumerate(implications):
+        for word in impl.premise:
+            k = word_index.get(word)
+            if k is not None:
+                premise_rows.append(rows[offsets[k]:offsets[k + 1]])
+                implication_ids.append(np.full(offsets[k + 1] - offsets[k],
+                                               i, dtype=np.int64))
+    result = [None] * len(implications)
+    if not premise_rows:
+        return result
+    premise_rows = np.concatenate(premise_rows)
+    keys = (np.concatenate(implication_ids) * len(sequences) +
+            codes[premise_rows])
+    order = np.lexsort((premise_rows, keys))
+    keys, first = np.unique(keys[order], return_index=True)
+    counts = np.add.reduceat(row_weights(data)[premise_rows[order]], first)
+    # earliest row of every (implication, sequence)
+    first = premise_rows[order][first]
+    implication_ids, sequence_ids = np.divmod(keys, len(sequences))
+    # per implication: highest count, then earliest row
+    best = np.lexsort((first, -counts, implication_ids))
+    implication_ids = implication_ids[best]
+    winners = np.flatnonzero(np.r_[True, np.diff(implication_ids) != 0])
+    for i, sequence in zip(implication_ids[winners].tolist(),
+                           sequence_ids[best][winners].tolist()):
+        result[i] = sequences[sequence]
+    return result
+
+
+class EditProgram(object):
+    """
+    An operation sequence parsed once into its edit steps: deletions of the
+    last occurrence of a string and appends, consecutive appends merged and
+    empty operations dropped. A program made of at most one deletion
+    followed by appends is a suffix rewrite ("strip X, append Y"), applied
+    by slicing to the words ending with X.
+    """
+
+    __slots__ = ('steps', 'strip', 'suffix')
+
+    def __init__(self, operation_sequence):
+        """operation_sequence is a list of operations as in apply_operation
+        or a string of operations joined by spaces"""
+        if isinstance(operation_sequence, str):
+            operation_sequence = operation_sequence.split(' ')
+        steps = []
+        for opn in operation_sequence:
+            if opn.startswith('::'):
+                if opn[2:]:
+                    steps.append((True, opn[2:]))
+            elif opn:
+                if steps and not steps[-1][0]:
+                    steps[-1] = (False, steps[-1][1] + opn)
+                else:
+                    steps.append((False, opn))
+        self.steps = tuple(steps)
+        self.strip = self.suffix = None
+        deletions = [part for delete, part in steps if delete]
+        if not deletions or (len(deletions) == 1 and steps[0][0]):
+            self.strip = deletions[0] if deletions else ''
+            self.suffix = ''.join(part for delete, part in steps
+                                  if not delete)
+
+    def __call__(self, word):
+        if self.strip is not None and word.endswith(self.strip):
+            return word[:len(word) - len(self.strip)] + self.suffix
+        for delete, part in self.steps:
+            if delete:
+                word = ''.join(word.rsplit(part, 1))
+            else:
+                word += part
+        return word
+
+    def apply(self, words):
+        """Applies the program to every word, returns a list"""
+        return [self(word) for word in words]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_operation(operation_sequence):
+    """Returns the EditProgram of an operation sequence (string or tuple),
+    compiled once per distinct sequence"""
+    return EditProgram(operation_sequence)
+
+
+def apply_operations(operation_sequences, words):
+    """Bulk apply_operation: applies operation_sequences[i] (strings of
+    space joined operations) to words[i]. Words sharing a sequence go
+    through its compiled program together. Returns a list."""
+    groups = collections.defaultdict(list)
+    for i, operation_sequence in enumerate(operation_sequences):
+        groups[operation_sequence].append(i)
+    result = [None] * len(operation_sequences)
+    for operation_sequence, indexes in groups.items():
+        outputs = compile_operation(operation_sequence).apply(
+            [words[i] for i in indexes])
+        for i, output in zip(indexes, outputs):
+            result[i] = output
+    return result
+
+
 def apply_operation(operation_sequence, word):
     """Applies operation sequence on the word"""
-    for opn in operation_sequence:
-        if opn.startswith('::'):
-            # delete operation
-            opn = opn[2:]
-            if opn == '':
-                continue
-            else:
-                word = delete(opn, word)
-        else:
-            # insert operation
-            word = insert(opn, word)
-    return word
+    return compile_operation(tuple(operation_sequence))(word)
 
 
 def delete(old, word, new='', occurrence=1):
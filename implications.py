@@ -5,6 +5,9 @@ Author: Gaurav Sahu, 23:20 15th January, 2018
 Implements the implication related methods for a given context.
 """
 
+import collections
+import numpy as np
+
 
 class Implication(object):
     """
@@ -32,15 +35,56 @@ class Implication(object):
     True
     """
 
+    # Implications are immutable, hence the hash is computed only once
+    __slots__ = ('premise', 'conclusion', '_hash')
+
     def __init__(self, premise_=frozenset(), conclusion_=frozenset()):
         """
         Create implication from two sets of attributes
         """
-        self.premise = premise_
-        self.conclusion = conclusion_
+        premise = frozenset(premise_)
+        conclusion = frozenset(conclusion_)
+        object.__setattr__(self, 'premise', premise)
+        object.__setattr__(self, 'conclusion', conclusion)
+        object.__setattr__(self, '_hash', hash((premise, conclusion)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Implication is immutable, build a new one")
+
+    def __delattr__(self, name):
+        raise AttributeError("Implication is immutable")
+
+    @classmethod
+    def from_bitsets(cls, premise, conclusion, attributes):
+        """
+        Create implication from two ints whose i-th bit stands for
+        attributes[i]
+        """
+        return cls(bitset_to_set(premise, attributes),
+                   bitset_to_set(conclusion, attributes))
+
+    def to_bitsets(self, bits):
+        """
+        Return premise and conclusion as ints, `bits` maps every attribute
+        to its bit
+        """
+        premise = 0
+        for a in self.premise:
+            premise |= bits[a]
+        conclusion = 0
+        for a in self.conclusion:
+            conclusion |= bits[a]
+        return premise, conclusion
+
+    def __reduce__(self):
+        # the cached hash is only valid for the current interpreter
+        return (Implication, (self.premise, self.conclusion))
+
+    def __copy__(self):
+        return self
 
     def __deepcopy__(self, memo):
-        return Implication(self.premise.copy(), self.conclusion.copy())
+        return self
 
     def get_premise(self):
         """
@@ -80,13 +124,13 @@ class Implication(object):
             return -1
 
     def __hash__(self):
-        return hash(frozenset((frozenset(self.premise),
-                               frozenset(self.conclusion))))
+        return self._hash
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return NotImplemented
-        return(self.premise == other.premise and
+        return(self._hash == other._hash and
+               self.premise == other.premise and
                self.conclusion == other.conclusion)
 
     def __lt__(self, other):
@@ -115,7 +159,7 @@ class Implication(object):
         # if some_set contains every element from premise and not every
         # element from conclusion then it doesn't respect an implication
         # TODO: refactor
-        if isinstance(some_set, set):
+        if isinstance(some_set, (set, frozenset)):
             return(self.conclusion.issubset(some_set) or not
                    self.premise.issubset(some_set))
         else:
@@ -124,6 +168,176 @@ class Implication(object):
                     not self.premise.issubset(some_set[0]))
 
 
+class Hypothesis(object):
+    """
+    A set of implications indexed by the attributes of their premises, used
+    as the hypothesis of HORN1-style learners.
+
+    Implications keep their insertion order, finding the implications whose
+    premise is contained in a set only touches the index entries of that
+    set's attributes, and strengthening or refining an implication replaces
+    it by a new one at the same position.
+    """
+
+    def __init__(self, implications=()):
+        self.implications = {}  # key => implication, in insertion order
+        self.index = {}         # attribute => keys of premises containing it
+        self.empty = set()      # keys of implications with empty premise
+        self.counts = {}        # implication => # keys holding it
+        self._next_key = 0
+        for implication in implications:
+            self.add(implication)
+
+    def __iter__(self):
+        return iter(list(self.implications.values()))
+
+    def __len__(self):
+        return len(self.implications)
+
+    def __contains__(self, implication):
+        return implication in self.counts
+
+    def _count(self, implication, step):
+        count = self.counts.get(implication, 0) + step
+        if count:
+            self.counts[implication] = count
+        else:
+            del self.counts[implication]
+
+    def _index(self, key, premise):
+        if not premise:
+            self.empty.add(key)
+        for a in premise:
+            self.index.setdefault(a, set()).add(key)
+
+    def _unindex(self, key, premise):
+        self.empty.discard(key)
+        for a in premise:
+            self.index[a].discard(key)
+
+    def add(self, implication):
+        """Appends implication and returns its key"""
+        key = self._next_key
+        self._next_key += 1
+        self.implications[key] = implication
+        self._index(key, implication.premise)
+        self._count(implication, 1)
+        return key
+
+    def remove(self, key):
+        implication = self.implications.pop(key)
+        self._unindex(key, implication.premise)
+        self._count(implication, -1)
+
+    def replace(self, key, implication):
+        """Replaces the implication at key, keeping its position"""
+        old = self.implications[key]
+        if old.premise != implication.premise:
+            self._unindex(key, old.premise)
+            self._index(key, implication.premise)
+        self._count(old, -1)
+        self._count(implication, 1)
+        self.implications[key] = implication
+
+    def _meeting(self, some_set):
+        """Returns {key: |premise ∩ some_set|} of the implications whose
+        premise meets some_set"""
+        count = {}
+        for a in some_set:
+            for key in self.index.get(a, ()):
+                count[key] = count.get(key, 0) + 1
+        return count
+
+    def premise_subsets(self, some_set):
+        """Returns the keys of implications whose premise is a subset of
+        some_set"""
+        count = self._meeting(some_set)
+        keys = set(self.empty)
+        for key, c in count.items():
+            if c == len(self.implications[key].premise):
+                keys.add(key)
+        return keys
+
+    def violated_by(self, some_set):
+        """Returns the keys of implications not respected by some_set"""
+        return [key for key in self.premise_subsets(some_set)
+                if not self.implications[key].conclusion <= some_set]
+
+    def is_respected(self, some_set):
+        return not self.violated_by(some_set)
+
+    def special_implication(self, counter_example, membership_oracle,
+                            closure_operator, batch_oracle=None):
+        """Same as findSpecialImplication, but returns the key of the
+        implication. Each distinct C ∩ A is asked to the oracle only once.
+        With batch_oracle (a list of sets => list of answers), all of them
+        are asked in one call instead, before the first failing one is
+        known.
+
+        Only the implications whose premise meets C are reached, through the
+        index: all the others have C ∩ A = ∅, so the earliest of them stands
+        for them all.
+        """
+        count = self._meeting(counter_example)
+        keys = sorted(key for key, c in count.items()
+                      if c < len(self.implications[key].premise))
+        for key in self.implications:
+            # earliest non-empty premise disjoint from C, found after at
+            # most len(count) + len(self.empty) steps
+            if key not in count and key not in self.empty:
+                keys.append(key)
+                keys.sort()
+                break
+        asked = {}
+        if batch_oracle is not None:
+            reduced = list(collections.OrderedDict.fromkeys(
+                frozenset(counter_example & self.implications[key].premise)
+                for key in keys))
+            asked = dict(zip(reduced, batch_oracle([set(s) for s in reduced])))
+        for key in keys:
+            implication = self.implications[key]
+            reduced = frozenset(counter_example & implication.premise)
+            if reduced not in asked:
+                asked[reduced] = membership_oracle(set(reduced),
+                                                   closure_operator)
+            if not asked[reduced]:
+                return key
+        return None
+
+    def strengthen(self, key, counter_example):
+        """A => B becomes A => B ∩ C"""
+        implication = self.implications[key]
+        self.replace(key, Implication(
+            implication.premise,
+            implication.conclusion & counter_example))
+
+    def refine(self, key, counter_example):
+        """A => B becomes C ∩ A => B ∪ (A \\ C)"""
+        implication = self.implications[key]
+        self.replace(key, Implication(
+            implication.premise & counter_example,
+            implication.conclusion | (implication.premise - counter_example)))
+
+
+def sort_basis(implications):
+    """Returns implications as a list sorted by decreasing premise length,
+    ties broken on the sorted premise and conclusion so that the order
+    does not depend on the hash seed"""
+    return sorted(implications,
+                  key=lambda impl: (-len(impl.premise), sorted(impl.premise),
+                                    sorted(impl.conclusion)))
+
+
+def bitset_to_set(bitset, attributes):
+    """Returns the set of attributes whose bits are set in bitset"""
+    some_set = set()
+    while bitset:
+        bit = bitset & -bitset
+        bitset ^= bit
+        some_set.add(attributes[bit.bit_length() - 1])
+    return some_set
+
+
 def findSpecialImplication(implications, membership_oracle,
                            closure_operator, counter_example):
     """Returns first implication (A --> B) such that it's premise(A)
@@ -143,9 +357,162 @@ def findSpecialImplication(implications, membership_oracle,
 def is_respected(implications, some_set):
     """Checks where some_set respects a set of implications
     """
+    if isinstance(implications, Hypothesis):
+        return implications.is_respected(some_set)
     for impl in implications:
         if not impl.is_respected(some_set):
             return False
         else:
             continue
     return True
+
+
+def attribute_bits(attributes):
+    """Maps every attribute to its bit, the j-th attribute to 1 << j as in
+    formalContext.attributeBitset"""
+    return dict((a, 1 << j) for j, a in enumerate(attributes))
+
+
+def bitset_words(bitsets, width):
+    """Returns ints as the rows of a uint64 matrix of shape
+    (len(bitsets), width), bit j of an int being bit j % 64 of word j // 64.
+    """
+    data = b''.join(bitset.to_bytes(8 * width, 'little')
+                    for bitset in bitsets)
+    return np.frombuffer(data, dtype='<u8').reshape(len(bitsets), width)
+
+
+def word_count(size):
+    """Number of uint64 words holding size bits"""
+    return max(1, (size + 63) // 64)
+
+
+def pack_bits(matrix):
+    """Returns a boolean matrix (one column per attribute) as the uint64
+    words of bitset_words"""
+    width = word_count(matrix.shape[1])
+    packed = np.packbits(matrix, axis=1, bitorder='little')
+    words = np.zeros((matrix.shape[0], 8 * width), dtype=np.uint8)
+    words[:, :packed.shape[1]] = packed
+    return words.view('<u8')
+
+
+def to_bitmasks(implications, attributes):
+    """Returns the premises and conclusions of implications as uint64
+    matrices of shape (len(implications), word_count(len(attributes))), see
+    bitset_words; row i holds the i-th implication.
+    """
+    bits = attribute_bits(attributes)
+    bitsets = [impl.to_bitsets(bits) for impl in implications]
+    width = word_count(len(attributes))
+    return (bitset_words([premise for premise, _ in bitsets], width),
+            bitset_words([conclusion for _, conclusion in bitsets], width))
+
+
+def sets_bitmasks(sets, attributes, chunk=1024):
+    """Returns sets (of attributes, or ints already coded as by
+    formalContext.attributeBitset) as a uint64 matrix, see bitset_words.
+    Sets of attributes are packed `chunk` at a time."""
+    width = word_count(len(attributes))
+    if all(isinstance(some_set, int) for some_set in sets):
+        return bitset_words(sets, width)
+    index = dict((a, j) for j, a in enumerate(attributes))
+    words = np.empty((len(sets), width), dtype=np.uint64)
+    for start in range(0, len(sets), chunk):
+        block = sets[start:start + chunk]
+        matrix = np.zeros((len(block), len(attributes)), dtype=bool)
+        coded = []
+        for i, some_set in enumerate(block):
+            if isinstance(some_set, int):
+                coded.append(i)
+            else:
+                matrix[i, list(map(index.__getitem__, some_set))] = True
+        words[start:start + len(block)] = pack_bits(matrix)
+        if coded:
+            words[start + np.array(coded)] = bitset_words(
+                [block[i] for i in coded], width)
+    return words
+
+
+def sets_matrix(sets, attributes):
+    """Returns a boolean matrix of shape (len(sets), len(attributes))"""
+    index = dict((a, j) for j, a in enumerate(attributes))
+    matrix = np.zeros((len(sets), len(attributes)), dtype=bool)
+    for i, some_set in enumerate(sets):
+        matrix[i, [index[a] for a in some_set]] = True
+    return matrix
+
+
+def respects_block(premises, conclusions, sets, chunk=1 << 22):
+    """Bulk version of Implication.is_respected on the bitmasks of
+    to_bitmasks and sets_bitmasks. Returns R with R[i, j] True iff sets[j]
+    respects the i-th implication.
+
+    Only the words holding a bit of a premise or conclusion are compared:
+    implications touching the same words are checked together, against
+    those columns of sets only, about `chunk` words at a time.
+    """
+    matrix = np.ones((len(premises), len(sets)), dtype=bool)
+    touched = (premises | conclusions) != 0
+    patterns, group = np.unique(touched, axis=0, return_inverse=True)
+    group = group.ravel()
+    for g, pattern in enumerate(patterns):
+        words = np.flatnonzero(pattern)
+        if not len(words):
+            # empty premise and conclusion, respected by every set
+            continue
+        rows = np.flatnonzero(group == g)
+        columns = sets[:, words][None, :, :]
+        step = max(1, chunk // (len(sets) * len(words)))
+        for start in range(0, len(rows), step):
+            block = rows[start:start + step]
+            premise = premises[block][:, words][:, None, :]
+            conclusion = conclusions[block][:, words][:, None, :]
+            # some_set ⊇ A  is  some_set & A == A, word by word
+            covered = ((columns & premise) == premise).all(axis=2)
+            concluded = ((columns & conclusion) == conclusion).all(axis=2)
+            matrix[block] = concluded | ~covered
+    return matrix
+
+
+def respects_matrix(implications, sets, attributes=None):
+    """Checks every set against every implication at once.
+    Returns a boolean matrix R with R[i, j] True iff the j-th set respects
+    the i-th implication. Sets must be complete examples, given as sets of
+    attributes or, along with attributes, as their bitsets.
+    """
+    implications = list(implications)
+    sets = list(sets)
+    if attributes is None:
+        attributes = set()
+        for impl in implications:
+            attributes |= impl.premise | impl.conclusion
+        for some_set in sets:
+            attributes |= set(some_set)
+        attributes = list(attributes)
+    premises, conclusions = to_bitmasks(implications, attributes)
+    return respects_block(premises, conclusions,
+                          sets_bitmasks(sets, attributes))
+
+
+def validate_basis(implications, sets, attributes=None):
+    """Validates a basis against a collection of sets, e.g. the object
+    intents of a context (see respects_matrix for sets and attributes).
+
+    Returns a dictionary with the respects matrix, the violations as
+    {implication index: [indexes of violating sets]}, the precision and the
+    recall. Precision is the share of implications that hold in every set,
+    i.e. that are valid in the context; recall is the share of sets that
+    are models of the whole basis.
+    """
+    matrix = respects_matrix(implications, sets, attributes)
+    valid_implications = matrix.all(axis=1)
+    models = matrix.all(axis=0)
+    violations = {}
+    for i in np.flatnonzero(~valid_implications):
+        violations[int(i)] = np.flatnonzero(~matrix[i]).tolist()
+    return {'matrix': matrix,
+            'violations': violations,
+            'precision': float(valid_implications.mean())
+            if matrix.shape[0] else 1.,
+            'recall': float(models.mean()) if matrix.shape[1] else 1.}
@@ -9,17 +9,139 @@ For more information, see:
    Correct Implication Bases, 2017
 """
 
-import random
+import json
 import math
+import time
+import random
+import contextlib
+import collections
+import numpy as np
 import implications as imp
+import closure_operators
+
+
+class QueryStats(object):
+    """
+    Accounting of a PAC learning run: number of equivalence and membership
+    queries, samples drawn, closures computed, seconds spent per phase,
+    the hypothesis size after every update, how often each kind of
+    update (strengthening, special implication, new implication) fired and
+    the confidence achieved by the returned hypothesis.
+    """
+
+    def __init__(self):
+        self.equivalence_queries = 0
+        self.membership_queries = 0
+        self.samples = 0
+        self.closures = 0
+        self.phase_seconds = {}
+        self.hypothesis_sizes = []
+        self.triggers = {'no_resp': 0, 'spec': 0, 'weak': 0}
+        # confidence of the returned hypothesis and whether it was
+        # returned because the budget ran out
+        self.confidence = None
+        self.exhausted = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with-block to phase `name`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.) + \
+                time.time() - start
+
+    def to_dict(self):
+        return {'equivalence_queries': self.equivalence_queries,
+                'membership_queries': self.membership_queries,
+                'samples': self.samples,
+                'closures': self.closures,
+                'phase_seconds': dict(self.phase_seconds),
+                'hypothesis_sizes': list(self.hypothesis_sizes),
+                'triggers': dict(self.triggers),
+                'confidence': self.confidence,
+                'exhausted': self.exhausted}
+
+    def to_json(self, path=None):
+        """Returns the stats as a JSON string, also written to path if
+        given"""
+        dump = json.dumps(self.to_dict(), sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as stats_out:
+                stats_out.write(dump)
+        return dump
+
+    def __repr__(self):
+        return self.to_json()
+
+
+def spawn_rngs(seed=None, n=1):
+    """Returns n statistically independent numpy Generators spawned from
+    one SeedSequence, e.g. one per best-of run or worker. The same seed
+    gives the same streams."""
+    return [np.random.default_rng(child)
+            for child in np.random.SeedSequence(seed).spawn(n)]
+
+
+def _random(rng):
+    """Uniform float in [0, 1) drawn from rng, or from the global random
+    module if rng is None"""
+    return random.random() if rng is None else rng.random()
+
+
+def _choice(seq, rng):
+    """Random element of the sequence seq, see _random"""
+    return random.choice(seq) if rng is None else seq[rng.integers(len(seq))]
 
 
 def member(_input_set, closure_operator):
     """
     Tells if the given element is present in the target hypothesis
     """
-    # _input ∈ targetHypothesis
-    return(_input_set == set(closure_operator(_input_set)))
+    # _input ∈ targetHypothesis. The closure contains _input_set, so
+    # comparing the sizes is enough
+    return(len(_input_set) == len(closure_operator(_input_set)))
+
+
+class MembershipCache(object):
+    """
+    Memoizing membership oracle, called like `member`.
+
+    Answers are keyed by the frozenset of the queried attributes and the
+    least recently used ones are evicted beyond `maxsize` entries. The
+    answers only depend on the context, so one cache can be shared by every
+    run learning from the same context (e.g. best-of runs).
+    """
+
+    def __init__(self, membership_oracle=member, maxsize=1000000):
+        self.membership_oracle = membership_oracle
+        self.maxsize = maxsize
+        self.answers = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, _input_set, closure_operator):
+        key = frozenset(_input_set)
+        answer = self.get(key)
+        if answer is None:
+            answer = self.membership_oracle(_input_set, closure_operator)
+            self.put(key, answer)
+        return answer
+
+    def get(self, key):
+        """Cached answer of the frozenset key, None if there is none"""
+        if key in self.answers:
+            self.hits += 1
+            self.answers.move_to_end(key)
+            return self.answers[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, answer):
+        self.answers[key] = answer
+        if len(self.answers) > self.maxsize:
+            self.answers.popitem(last=False)
 
 
 def equivalent(_input_set, formal_concept, membership_oracle,
@@ -28,7 +150,7 @@ def equivalent(_input_set, formal_concept, membership_oracle,
     context or not. If not, returns a counter-example.
     Here _input_set (H) is a set of implications of the form A --> B,
     context_intents = Int(K)"""
-    if not isinstance(_input_set, set):
+    if not isinstance(_input_set, (set, imp.Hypothesis)):
         print("Inputs must be a set for the equivalence query")
     else:
         # input = intents
@@ -43,20 +165,123 @@ def equivalent(_input_set, formal_concept, membership_oracle,
         return {'bool': True, 'value': None}
 
 
+def exact_equivalent(_input_set, formal_concept, membership_oracle,
+                     closure_operator, restricted=False):
+    """Exact equivalence query decided on the intents of the concept
+    lattice, which is computed first if needed.
+    An intent violating the hypothesis is a positive counter-example.
+    Otherwise every intent is closed under the hypothesis, so walking the
+    hypothesis' closed sets in lectic order meets a set which is no intent
+    (a negative counter-example) after at most |intents| steps, or proves
+    that the hypothesis is equivalent to the context.
+    Same signature as `equivalent`, the oracles are not needed."""
+    if not formal_concept.concepts:
+        formal_concept.computeLattice()
+    attributes = formal_concept.context.attributes
+    hypothesis = list(_input_set)
+    intents = [concept.intent for concept in formal_concept.concepts]
+    respected = imp.respects_matrix(hypothesis, intents, attributes).all(
+        axis=0)
+    violating = np.flatnonzero(~respected)
+    if len(violating):
+        return {'bool': False, 'value': set(intents[violating[0]])}
+
+    intents = set(intents)
+    close = closure_operators.CompiledClosure(hypothesis, attributes)
+    for closed_set in closure_operators.next_closure(attributes, close):
+        if frozenset(closed_set) not in intents:
+            return {'bool': False, 'value': closed_set}
+    return {'bool': True, 'value': None}
+
+
+def sample_size(i, epsilon, delta, schedule='angluin'):
+    """Number of samples the i-th approximate equivalence query draws.
+
+    'angluin': l_i = ⌊(i - log₂δ) / ε⌋, the i-th query fails with
+               probability at most δ / 2^i.
+    'adaptive': l_i = ⌈ln(1 / δ_i) / ε⌉ with δ_i = 6δ / (π²(i + 1)²). The
+               δ_i still sum up to δ over any number of queries, so the
+               (ε, δ) guarantee holds whenever the learner stops, but l_i
+               grows like log i instead of i.
+    """
+    if schedule == 'adaptive':
+        delta_i = query_delta(i, delta, schedule)
+        return int(math.ceil(math.log(1 / delta_i) / epsilon))
+    return int(math.floor((i - math.log(delta, 2)) / epsilon))
+
+
+def query_delta(i, delta, schedule='angluin'):
+    """δ_i, the probability that the i-th query of the schedule accepts a
+    hypothesis with error above ε, see sample_size"""
+    if schedule == 'adaptive':
+        return 6 * delta / (math.pi ** 2 * (i + 1) ** 2)
+    return delta / 2. ** i
+
+
+def accepted(i, delta, schedule='angluin'):
+    """Answer of an approximate equivalence query that drew all of its
+    samples without finding a counter-example"""
+    return {'bool': True, 'value': None,
+            'confidence': 1 - query_delta(i, delta, schedule)}
+
+
+def samples_left(budget, stats):
+    """Samples the budget ({'samples': max # samples or None,
+    'deadline': time.time() limit or None, 'cancel': an Event stopping the
+    run once set, or None}) still allows, None if unlimited"""
+    if budget.get('deadline') is not None and time.time() >= budget['deadline']:
+        return 0
+    if budget.get('cancel') is not None and budget['cancel'].is_set():
+        return 0
+    if budget.get('samples') is not None:
+        return max(budget['samples'] - stats.samples, 0)
+    return None
+
+
+def exhausted(samples, i, epsilon, delta, schedule='angluin'):
+    """Answer of the i-th approximate equivalence query cut short by the
+    budget after `samples` samples agreeing with the hypothesis. A
+    hypothesis with error above ε passes them with probability at most
+    (1 - ε)^samples; the confidence never exceeds the 1 - δ_i of the full
+    query (see accepted)."""
+    return {'bool': True, 'value': None, 'exhausted': True,
+            'confidence': min(1 - (1 - epsilon) ** samples,
+                              1 - query_delta(i, delta, schedule))}
+
+
 def approx_equivalent(_input_set, membership_oracle, formal_concept,
-                      closure_operator, i, counter, epsilon=0.1, delta=0.1):
+                      closure_operator, i, counter, epsilon=0.1, delta=0.1,
+                      sampler=None, stats=None, schedule='angluin',
+                      budget=None, rng=None):
     """ _input_set is the hypothesis set
     counter is a dictionary showing how many times each of the blocks has been
     triggers continuously
+    sampler(formal_concept, hypothesis, rng) draws the samples, see
+    `uniform_sampler` and the others. By default samples are uniform and
+    forced to disagree with the hypothesis after 7 queries.
+    rng is the numpy Generator of the run (see `spawn_rngs`), the global
+    random module is used if it is None
+    stats is an optional QueryStats counting the samples drawn
+    schedule is the sample schedule, see `sample_size`
+    budget (see `samples_left`, needs stats) stops the query early, the
+    answer then holds 'exhausted'. Answers without counter-example hold the
+    'confidence' achieved, from the δ_i the schedule sized the query with
     """
-    l_i = math.floor((i - math.log(delta, 2)) / epsilon)
-    for j in range(int(l_i)):
-        sample = genCounterExample(formal_concept)
+    l_i = sample_size(i, epsilon, delta, schedule)
+    for j in range(l_i):
+        if budget is not None and samples_left(budget, stats) == 0:
+            return exhausted(j, i, epsilon, delta, schedule)
+        if stats is not None:
+            stats.samples += 1
+        if sampler is not None:
+            sample = sampler(formal_concept, _input_set, rng)
+        else:
+            sample = genCounterExample(formal_concept, rng=rng)
         is_member = membership_oracle(sample, closure_operator)
         respects = imp.is_respected(_input_set, sample)
-        if i > 7:
+        if sampler is None and i > 7:
             if counter['no_resp'] < 8 or counter['weak'] > 2:
-                random_impl = random.choice(list(_input_set))
+                random_impl = _choice(list(_input_set), rng)
                 # try to forcefully disrespect
                 sample = sample.intersection(random_impl.premise)
                 sample = set(closure_operator(sample))
@@ -64,7 +289,71 @@ def approx_equivalent(_input_set, membership_oracle, formal_concept,
                 respects = imp.is_respected(_input_set, sample)
         if ((is_member and not respects) or (not is_member and respects)):
             return {'bool': False, 'value': sample}
-    return {'bool': True, 'value': None}
+    return accepted(i, delta, schedule)
+
+
+def sample_block(formal_concept, size, rng):
+    """Draws `size` uniform random attribute sets at once as a boolean
+    matrix (one row per sample, one column per context attribute).
+    `rng` is a numpy Generator, the same seed gives the same block."""
+    return rng.random((size, len(formal_concept.context.attributes))) < 0.5
+
+
+def member_block(block, formal_concept):
+    """Bulk version of member: tells for every row of the boolean matrix
+    `block` whether it is an intent of the context, i.e. equals its closure.
+    """
+    missing = (~formal_concept.context.incidenceMatrix()).astype(np.float32)
+    # objects having every attribute of the sample
+    extent = (block.astype(np.float32) @ missing.T) == 0
+    # attributes shared by all those objects
+    closure = (extent.astype(np.float32) @ missing) == 0
+    return (closure == block).all(axis=1)
+
+
+def approx_equivalent_block(_input_set, membership_oracle, formal_concept,
+                            closure_operator, i, counter, epsilon=0.1,
+                            delta=0.1, block_size=1024, rng=None,
+                            stats=None, schedule='angluin', budget=None):
+    """Vectorized approx_equivalent: draws the same number of uniform
+    samples, but in blocks of `block_size`. Membership and respect of the
+    hypothesis are decided for a whole block (membership with matrix
+    products, respect on bitmasks), and the first disagreeing sample is
+    returned.
+    `membership_oracle` and `closure_operator` are unused, they are only
+    kept so that both oracles can be passed to pac_basis interchangeably.
+    schedule and budget work as for approx_equivalent.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    attributes = formal_concept.context.attributes
+    premises, conclusions = imp.to_bitmasks(list(_input_set), attributes)
+    l_i = sample_size(i, epsilon, delta, schedule)
+    drawn = 0
+    while drawn < l_i:
+        size = min(block_size, l_i - drawn)
+        if budget is not None:
+            left = samples_left(budget, stats)
+            if left == 0:
+                return exhausted(drawn, i, epsilon, delta, schedule)
+            if left is not None:
+                size = min(size, left)
+        block = sample_block(formal_concept, size, rng)
+        if stats is not None:
+            # each sample is one membership query and one closure
+            stats.samples += len(block)
+            stats.membership_queries += len(block)
+            stats.closures += len(block)
+        is_member = member_block(block, formal_concept)
+        respects = imp.respects_block(premises, conclusions,
+                                      imp.pack_bits(block)).all(axis=0)
+        disagreements = np.flatnonzero(is_member != respects)
+        if len(disagreements):
+            row = block[disagreements[0]]
+            return {'bool': False,
+                    'value': set(attributes[j] for j in np.flatnonzero(row))}
+        drawn += len(block)
+    return accepted(i, delta, schedule)
 
 
 def subset(restricted=False):
@@ -110,13 +399,76 @@ def exhaustive(restricted=False):
     print("`exaustive` method is still to be implemented")
 
 
-def genCounterExample(formal_concept, oracle_type='equivalence'):
+def genCounterExample(formal_concept, oracle_type='equivalence', rng=None):
     """Leaving room for generating counter-examples for other types of
-    oracles too"""
+    oracles too. With a numpy Generator rng the attributes are drawn in
+    context order, so the same stream gives the same counter-examples."""
     if oracle_type == 'equivalence':
         attributes = formal_concept.context.attributes
+        if rng is not None:
+            return set(attributes[j] for j in
+                       np.flatnonzero(rng.random(len(attributes)) < 0.5))
         counter_example = set()
         for attr in random.sample(attributes, k=len(attributes)):
             if random.random() > 0.5:
                 counter_example.add(attr)
         return counter_example
+
+
+def uniform_sampler(formal_concept, hypothesis, rng=None):
+    """Every attribute is drawn with probability 1/2"""
+    return genCounterExample(formal_concept, rng=rng)
+
+
+def intent_sampler(formal_concept, hypothesis, rng=None):
+    """The intent of a random object, half of the time without one of its
+    attributes. Samples are positive examples or lie right below one, which
+    suits sparse contexts where uniform samples are almost never intents."""
+    context = formal_concept.context
+    sample = set(context.objectsToAttributes[_choice(context.objects, rng)])
+    if sample and _random(rng) < 0.5:
+        sample.remove(_choice(
+            [m for m in context.attributes if m in sample], rng))
+    return sample
+
+
+def frequency_sampler(formal_concept, hypothesis, rng=None):
+    """Every attribute m is drawn with probability |m'| / |G|, scaled by the
+    relative weight of m in a weighted context (see
+    formalContext.attributeFrequencies)"""
+    context = formal_concept.context
+    frequencies = context.attributeFrequencies()
+    return set(m for m in context.attributes
+               if _random(rng) < frequencies[m])
+
+
+def hypothesis_sampler(formal_concept, hypothesis, rng=None):
+    """Targets a random implication A => B of the hypothesis: either A with
+    a random part of B, which tests whether the conclusion is too strong,
+    or the closure of a random part of A, which tests whether the premise
+    is too weak. Falls back to frequency_sampler on an empty hypothesis.
+    Samples are plain sets, also when the hypothesis is a plain set of
+    implications:
+
+    >>> import concept_context as cn
+    >>> concepts = cn.formalConcepts([('x', 'a'), ('x', 'b'), ('y', 'a')])
+    >>> close = lambda s: closure_operators.aclosure(s, concepts.context)
+    >>> hypothesis = set([imp.Implication(['a'], ['a', 'b'])])
+    >>> approx_equivalent(hypothesis, member, concepts, close, 1,
+    ...                   {'no_resp': 0, 'weak': 0},
+    ...                   sampler=hypothesis_sampler,
+    ...                   rng=np.random.default_rng(0))['bool']
+    False
+    """
+    implications = list(hypothesis)
+    if not implications:
+        return frequency_sampler(formal_concept, hypothesis, rng)
+    context = formal_concept.context
+    implication = _choice(implications, rng)
+    if _random(rng) < 0.5:
+        return set(implication.premise) | set(
+            m for m in context.attributes
+            if m in implication.conclusion and _random(rng) < 0.5)
+    return set(closure_operators.aclosure(
+        set(m for m in context.attributes
+            if m in implication.premise and _random(rng) < 0.5), context))
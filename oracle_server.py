@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-process oracles.
+
+A server process owns the formal contexts (by name), one membership cache
+per context and the counter-example samplers, and answers batched `member`
+and `approx_equivalent` requests from any number of learner processes. The
+learners then share one context and its warm cache instead of each building
+their own.
+
+    # server (or oracle_server.start() to fork one)
+    python oracle_server.py serve 50000 secret
+
+    # learner
+    server = oracle_server.connect(('localhost', 50000), b'secret')
+    server.add_context('english-V', relations)
+    remote = oracle_server.RemoteConcepts(server, 'english-V')
+    hypothesis, stats = basis.pac_basis(
+        remote, remote.close, remote.member, 0.1, 0.1,
+        remote.approx_equivalent, membership_batch=remote.member_batch)
+
+The address may also be the path of a Unix socket.
+"""
+
+import sys
+import threading
+from multiprocessing.managers import BaseManager
+
+import oracle
+import closure_operators
+import implications as imp
+import concept_context as cn
+
+SAMPLERS = {
+    'uniform': oracle.uniform_sampler,
+    'intent': oracle.intent_sampler,
+    'frequency': oracle.frequency_sampler,
+    'hypothesis': oracle.hypothesis_sampler,
+}
+
+
+class OracleService(object):
+    """
+    The object served by the server process. Every learner connection is
+    handled in its own thread; each context has a lock around the lookups
+    and insertions of its cache only, so the queries of concurrent learners
+    (their sampling and closures) run side by side.
+    """
+
+    def __init__(self, maxsize=1000000):
+        self.maxsize = maxsize
+        self.concepts = {}
+        self.caches = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def add_context(self, name, relation, objects=None, attributes=None):
+        """Builds the context `name` from (object, attribute) tuples unless
+        it already exists. Returns whether it was built."""
+        with self.lock:
+            if name in self.concepts:
+                return False
+            self.concepts[name] = cn.formalConcepts(relation, objects,
+                                                    attributes)
+            self.caches[name] = oracle.MembershipCache(maxsize=self.maxsize)
+            self.locks[name] = threading.Lock()
+        print("Added context %s" % name)
+        return True
+
+    def contexts(self):
+        return sorted(self.concepts)
+
+    def attributes(self, name):
+        return list(self.concepts[name].context.attributes)
+
+    def _close(self, name):
+        context = self.concepts[name].context
+
+        def close(attributes):
+            return closure_operators.aclosure(attributes, context)
+        return close
+
+    def close(self, name, attribute_sets):
+        """Closures of a batch of attribute sets"""
+        close = self._close(name)
+        return [set(close(set(s))) for s in attribute_sets]
+
+    def _member(self, name):
+        """The cached membership oracle of the context `name`"""
+        cache = self.caches[name]
+        lock = self.locks[name]
+
+        def member(attribute_set, closure_operator):
+            key = frozenset(attribute_set)
+            with lock:
+                answer = cache.get(key)
+            if answer is None:
+                answer = cache.membership_oracle(set(key), closure_operator)
+                with lock:
+                    cache.put(key, answer)
+            return answer
+        return member
+
+    def member(self, name, attribute_set):
+        """Membership answer for one attribute set"""
+        return self._member(name)(attribute_set, self._close(name))
+
+    def member_batch(self, name, attribute_sets):
+        """Membership answers for a batch of attribute sets"""
+        member = self._member(name)
+        close = self._close(name)
+        return [member(s, close) for s in attribute_sets]
+
+    def approx_equivalent(self, name, hypothesis, i, counter, epsilon=0.1,
+                          delta=0.1, sampler=None, schedule='angluin',
+                          budget=None, rng=None):
+        """Runs oracle.approx_equivalent on the context `name` with the
+        cached membership oracle. `hypothesis` is a list of implications,
+        `sampler` the name of one of SAMPLERS or None and budget['samples']
+        counts the samples this query may still draw. Returns the answer,
+        the QueryStats of the query as a dict and rng in its new state."""
+        stats = oracle.QueryStats()
+        close = self._close(name)
+        member = self._member(name)
+
+        def counted_closure(s):
+            stats.closures += 1
+            return close(s)
+
+        def counted_member(s, closure_operator):
+            stats.membership_queries += 1
+            return member(s, closure_operator)
+
+        target = imp.Hypothesis()
+        for implication in hypothesis:
+            target.add(implication)
+        answer = oracle.approx_equivalent(
+            target, counted_member, self.concepts[name], counted_closure,
+            i, counter, epsilon, delta,
+            sampler=SAMPLERS[sampler] if sampler else None, stats=stats,
+            schedule=schedule, budget=budget, rng=rng)
+        return answer, stats.to_dict(), rng
+
+    def cache_info(self, name):
+        cache = self.caches[name]
+        with self.locks[name]:
+            return {'size': len(cache.answers), 'hits': cache.hits,
+                    'misses': cache.misses}
+
+
+_SERVICE = None
+
+
+def _service():
+    global _SERVICE
+    if _SERVICE is None:
+        _SERVICE = OracleService()
+    return _SERVICE
+
+
+class OracleManager(BaseManager):
+    pass
+
+
+OracleManager.register('oracle', callable=_service)
+
+
+def serve(address=('localhost', 50000), authkey=b'oracle'):
+    """Serves the oracles from this process until interrupted"""
+    server = OracleManager(address=address, authkey=authkey).get_server()
+    print("Serving oracles on %s" % (address,))
+    server.serve_forever()
+
+
+def start(address=None, authkey=None):
+    """Starts a server process and returns its manager, stop it with
+    manager.shutdown()"""
+    manager = OracleManager(address=address, authkey=authkey)
+    manager.start()
+    return manager
+
+
+def connect(address=('localhost', 50000), authkey=b'oracle'):
+    """Returns a proxy of the OracleService served at address"""
+    manager = OracleManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.oracle()
+
+
+class RemoteContext(object):
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+
+class RemoteConcepts(object):
+    """
+    Stands in for the formalConcepts of the served context `name` in
+    basis.pac_basis: `close`, `member` and `approx_equivalent` are the
+    closure operator and the oracles to pass along with it.
+    """
+
+    def __init__(self, server, name, sampler=None):
+        self.server = server
+        self.name = name
+        self.sampler = sampler
+        self.context = RemoteContext(server.attributes(name))
+
+    def close(self, attributes):
+        return self.server.close(self.name, [attributes])[0]
+
+    def member(self, _input_set, closure_operator=None):
+        return self.server.member(self.name, _input_set)
+
+    def member_batch(self, attribute_sets):
+        """Membership answers of a list of sets in one round trip, the
+        membership_batch of basis.pac_basis"""
+        return self.server.member_batch(self.name, list(attribute_sets))
+
+    def approx_equivalent(self, _input_set, membership_oracle, formal_concept,
+                          closure_operator, i, counter, epsilon=0.1,
+                          delta=0.1, stats=None, schedule='angluin',
+                          budget=None, rng=None):
+        """Same signature as oracle.approx_equivalent, the query runs on the
+        server and its counts are added to stats. rng is shipped along and
+        advanced as if the query had run here."""
+        if budget is not None:
+            if oracle.samples_left(budget, stats) == 0:
+                return oracle.exhausted(0, i, epsilon, delta, schedule)
+            # the cancel Event stays here, it is checked between queries
+            budget = dict(budget, cancel=None)
+        if budget is not None and budget.get('samples') is not None:
+            # the server counts the samples of this query only
+            budget = dict(budget, samples=max(
+                budget['samples'] - stats.samples, 0))
+        answer, counts, used_rng = self.server.approx_equivalent(
+            self.name, list(_input_set), i, counter, epsilon, delta,
+            self.sampler, schedule, budget, rng)
+        if rng is not None:
+            rng.bit_generator.state = used_rng.bit_generator.state
+        if stats is not None:
+            stats.samples += counts['samples']
+            stats.membership_queries += counts['membership_queries']
+            stats.closures += counts['closures']
+        return answer
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'serve':
+        print(__doc__)
+        sys.exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    authkey = sys.argv[3].encode() if len(sys.argv) > 3 else b'oracle'
+    serve(('localhost', port), authkey)
@@ -15,95 +15,188 @@ For more information, see:
 import os
 import sys
 import copy
+import traceback
+import basis
 import helper
+import preprocess
+import implications
 import operator
 import _pickle as pickle
-import pandas as pd
 import concept_context as cn
+from concurrent import futures
 
 TRAIN_DIR = 'data/train/'
 DEV_DIR = 'data/dev/'
 COV_TEST_DIR = 'data/test/covered/'
 UNCOV_TEST_DIR = 'data/test/uncovered/'
 PAC_DIR = 'data/out/pac/'
+ALIGNMENT_CACHE = 'data/out/alignments.db'
+PREPROCESSED_DIR = 'data/out/preprocessed/'
 
 
-def calculateAndSavePacBasis(train_dir, filter_pac=True):
+def pacBasisForPos(temp_train_data, relation, filter_pac=True,
+                   basis_type='pac', minimize=False):
+    """
+    Computes the basis of the rows of one POS tag, see
+    preprocess.LanguageData.subset for temp_train_data and relation.
+    Returns the basis and the operation sequence of each implication.
+    """
+    # number of attributes (distinct source words) of the context, rows
+    # are deduplicated into weighted ones
+    attribute_size = temp_train_data['source'].nunique()
+
+    # Build the concept lattice
+    concepts = cn.formalConcepts.fromCodes(*relation)
+    concepts.computeLattice()
+
+    # Find canonical basis
+    concepts.computeCanonicalBasis(epsilon=0.1, delta=0.1,
+                                   basis_type=basis_type)
+
+    print("Total implications: {}\n".format(len(concepts.canonical_basis)))
+
+    validation = implications.validate_basis(
+        concepts.canonical_basis, concepts.context.objectBitsets(),
+        concepts.context.attributes)
+    print("Basis precision: {}, recall: {}\n".format(
+        validation['precision'], validation['recall']))
+
+    if minimize:
+        # Drop redundant implications before matching against them
+        concepts.canonical_basis = basis.minimize_basis(
+            concepts.canonical_basis)
+        print("Implications after minimization: {}\n".format(
+            len(concepts.canonical_basis)))
+
+    unique_conclusions = []
+    filtered_basis = []
+    for impl in concepts.canonical_basis:
+        unique_conclusions.append(frozenset(impl.conclusion))
+        if len(impl.premise) == 0:
+            continue
+        if filter_pac:
+            # Remove implications of the form C --> M and C --> C
+            if impl.premise == impl.conclusion or len(
+                    impl.conclusion) == attribute_size:
+                continue
+        filtered_basis.append(impl)
+    concepts.canonical_basis = filtered_basis
+
+    print("Total UNIQUE conclusions: {}\n".format(len(set(unique_conclusions))))
+    # a list, so that implication i keeps operation sequence i once saved
+    concepts.canonical_basis = implications.sort_basis(
+        concepts.canonical_basis)
+
+    # most common operation sequence of the premise rows of every implication
+    implId_opnSeq_map = dict(enumerate(helper.operations(
+        concepts.canonical_basis, temp_train_data)))
+
+    return (concepts.canonical_basis, implId_opnSeq_map)
+
+
+def calculateAndSavePacBasis(train_dir, filter_pac=True, basis_type='pac',
+                             minimize=False, alignment_cache=ALIGNMENT_CACHE,
+                             store=PREPROCESSED_DIR):
     """
     Parameters:
     -----------------
     train_dir (Str): Path to the training file
     test_dir (Str): Path to the testing file
+    basis_type (Str): 'pac', 'proper_premises' or 'direct'
+    minimize (Bool): Replace the basis by a minimum cover before filtering,
+                     which changes the premises the operations are learned
+                     from; the evaluation scripts score unminimized bases
+    alignment_cache (Str): Path of the helper.AlignmentCache, None to align
+                           every pair again
+    store (Str): Directory of the preprocessed training files, see
+                 preprocess.LanguageData.from_store, None to preprocess
+                 train_dir again
     """
 
-    # Load training and testing data into a dataframe
+    # Load, align and code the training data once for all POS tags
     pac_per_pos = dict()
-    train_data = pd.read_csv(train_dir, sep='\t', names=['source', 'target',
-                                                         'pos_info'])
-
-    uniq_pos_list = train_data['pos_info'].unique()
-    uniq_pos = set()
-    for pos_group in uniq_pos_list:
-        for pos in pos_group.split(';'):
-            uniq_pos.add(pos)
-    for pos in uniq_pos:
+    cache = None
+    if alignment_cache:
+        cache = helper.AlignmentCache(alignment_cache)
+    language = preprocess.LanguageData.from_store(train_dir, store, cache)
+    for pos in language.pos_tags():
         print("for pos ==> {}".format(pos))
-        temp_train_data = []
-        for row in train_data.iterrows():
-            if pos in row[1]['pos_info'].split(';'):
-                temp_train_data.append(row[1])
-            else:
-                continue
-        temp_train_data = pd.DataFrame.from_records(temp_train_data)
+        temp_train_data, relation = language.subset(pos)
 
-        attribute_size = temp_train_data['source'].size
-
-        # process training data
-        temp_train_data = temp_train_data.apply(helper.iterLCS, axis=1)
-
-        relations = helper.build_relations(temp_train_data)
-
-        # Build the concept lattice
-        concepts = cn.formalConcepts(relations)
-        concepts.computeLattice()
-
-        # Find canonical basis
-        concepts.computeCanonicalBasis(epsilon=0.1, delta=0.1, basis_type='pac')
-
-        print("Total implications: {}\n".format(len(concepts.canonical_basis)))
+        pac_per_pos[pos] = pacBasisForPos(temp_train_data, relation,
+                                          filter_pac, basis_type, minimize)
+    if cache is not None:
+        cache.close()
+    return pac_per_pos
 
-        unique_conclusions = []
-        for impl in copy.deepcopy(concepts.canonical_basis):
-            if len(impl.premise) == 0:
-                concepts.canonical_basis.remove(impl)
-            if filter_pac:
-                # Remove implications of the form C --> M and C --> C
-                if impl.premise == impl.conclusion or len(
-                        impl.conclusion) == attribute_size:
-                    concepts.canonical_basis.remove(impl)
-            unique_conclusions.append(frozenset(impl.conclusion))
 
-        print("Total UNIQUE conclusions: {}\n".format(len(set(unique_conclusions))))
-        concepts.canonical_basis = set(
-            sorted(
-                list(
-                    concepts.canonical_basis),
-                reverse=True))
+def _pos_job(lang, pos, temp_train_data, relation, filter_pac, basis_type,
+             minimize):
+    try:
+        return pacBasisForPos(temp_train_data, relation, filter_pac,
+                              basis_type, minimize), None
+    except Exception:
+        return None, traceback.format_exc()
 
-        implId_opnSeq_map = {}
-        for idx, impl in enumerate(concepts.canonical_basis):
-            premise = temp_train_data['source'].isin(impl.premise)
-            premise_data = temp_train_data[premise]
-            implId_opnSeq_map[idx] = helper.operation(premise_data)
 
-        pac_per_pos[pos] = (concepts.canonical_basis, implId_opnSeq_map)
-    return pac_per_pos
+def schedulePacJobs(train_dirs, workers=None, filter_pac=True,
+                    basis_type='pac', minimize=False,
+                    alignment_cache=ALIGNMENT_CACHE, store=PREPROCESSED_DIR):
+    """
+    Computes the bases of every (language, POS) of the training files on a
+    pool of `workers` processes. The training files are preprocessed here
+    once (or loaded from store, see calculateAndSavePacBasis), then the jobs
+    are submitted largest first (by number of relation pairs) so that the
+    sweep takes about as long as its largest job.
+    Returns {lang: pac_per_pos} as calculateAndSavePacBasis would, and
+    {(lang, pos): traceback} of the jobs that failed, which leave the others
+    untouched.
+    """
+    cache = None
+    if alignment_cache:
+        cache = helper.AlignmentCache(alignment_cache)
+    jobs = []
+    for train_dir in train_dirs:
+        lang = train_dir.split('/')[-1]
+        language = preprocess.LanguageData.from_store(train_dir, store, cache)
+        for pos in language.pos_tags():
+            temp_train_data, relation = language.subset(pos)
+            jobs.append((len(relation[0]), lang, pos, temp_train_data,
+                         relation))
+    if cache is not None:
+        cache.close()
+    jobs.sort(key=operator.itemgetter(0), reverse=True)
+
+    pac_per_lang = dict((train_dir.split('/')[-1], {})
+                        for train_dir in train_dirs)
+    failures = {}
+    with futures.ProcessPoolExecutor(workers) as executor:
+        pending = dict(
+            (executor.submit(_pos_job, lang, pos, temp_train_data, relation,
+                             filter_pac, basis_type, minimize), (lang, pos))
+            for size, lang, pos, temp_train_data, relation in jobs)
+        for future in futures.as_completed(pending):
+            lang, pos = pending[future]
+            try:
+                result, error = future.result()
+            except Exception:
+                # e.g. the worker process died
+                result, error = None, traceback.format_exc()
+            if error is None:
+                pac_per_lang[lang][pos] = result
+            else:
+                failures[(lang, pos)] = error
+                print("Failed {} at POS {}:\n{}".format(lang, pos, error))
+    return pac_per_lang, failures
 
 
 def findAllPacBases(training_files, method='uncov_test', level='medium',
-                    filter_pac=True, start_fresh=False):
+                    filter_pac=True, start_fresh=False, basis_type='pac',
+                    workers=None, minimize=False):
     """
-    Calculates and stores the best PAC-basis per POS config per language
+    Calculates and stores the best PAC-basis per POS config per language.
+    With `workers`, all the (language, POS) jobs run on a process pool, see
+    schedulePacJobs. See calculateAndSavePacBasis for minimize.
     """
     if method == 'uncov_test':
         testing_files = os.listdir(UNCOV_TEST_DIR)
@@ -127,29 +220,29 @@ def findAllPacBases(training_files, method='uncov_test', level='medium',
     # sort the list so that trainig and testing files are aligned
 
     acc_wrdMap = {}
+    if workers:
+        acc_wrdMap, failures = schedulePacJobs(
+            [TRAIN_DIR + train_file for train_file in training_files],
+            workers, filter_pac, basis_type, minimize)
     for idx, train_file in enumerate(training_files):
         lang = train_file.split('/')[-1]
         # if lang + '.p' in os.listdir(PAC_DIR) and not start_fresh:
         #     continue
-        print('*********Finding best pac-basis for {}...**********'.format(lang))
-        pac_per_pos = calculateAndSavePacBasis(
-            TRAIN_DIR + train_file,
-            filter_pac)
-        try:
-            for pos in pac_per_pos:
-                acc_wrdMap[lang][pos].append(pac_per_pos[pos])
-        except KeyError:
-            acc_wrdMap[lang] = {pos: [pac_per_pos[pos]]}
-
-        for pos in copy.deepcopy(acc_wrdMap[lang]):
-            acc_wrdMap[lang][pos] = max(acc_wrdMap[lang][pos], key=operator.itemgetter(0))
-
-        # Save the best pac-basis for all the languages along with accuracy
-        # word-map found for exact matching
+        if not workers:
+            print('*********Finding best pac-basis for {}...**********'.format(lang))
+            acc_wrdMap[lang] = calculateAndSavePacBasis(
+                TRAIN_DIR + train_file,
+                filter_pac,
+                basis_type,
+                minimize)
+
+        # Save the pac-basis for all the languages along with the operation
+        # sequence of every implication
         for pos in acc_wrdMap[lang]:
-            print('***********Saved best PAC-basis for {} at POS {} with accuracy {}%!***********'.format(lang, pos, acc_wrdMap[lang][pos][0] * 100))
+            print('***********Saved PAC-basis for {} at POS {} with {} implications!***********'.format(lang, pos, len(acc_wrdMap[lang][pos][0])))
         # with open(PAC_DIR + lang + '.p', 'wb') as pac_out:
         #     pickle.dump(acc_wrdMap[lang], pac_out)
+    return acc_wrdMap
 
 if __name__ == '__main__':
     findAllPacBases(
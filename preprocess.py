@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Preprocessing of a training file shared by all of its POS subsets.
+
+Duplicate rows are collapsed into weighted rows, every row is aligned once
+and the whole relation is integer coded once (see helper.relation_codes); an
+inverted index POS => rows then gives the rows of every POS subset, and a
+subset's relation is sliced from the shared one in time linear in the number
+of its rows.
+
+    language = preprocess.LanguageData.from_file('data/train/english-train-low')
+    for pos in language.pos_tags():
+        data, relation = language.subset(pos)
+        concepts = cn.formalConcepts.fromCodes(*relation)
+
+LanguageData.from_store keeps the preprocessed arrays of every training file
+as .npy files in a directory of its own, keyed by the hash of the file, and
+memory-maps them back on later runs.
+"""
+
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+import pandas as pd
+
+import helper
+
+# part of the store keys, bump it when LanguageData changes its arrays
+STORE_VERSION = 1
+TEXT_COLUMNS = ('source', 'target', 'pos_info')
+
+
+def file_hash(path, chunksize=1 << 20):
+    """Returns the sha1 hex digest of the contents of the file at path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_key(train_dir):
+    """Identifies the preprocessed arrays of a training file: its contents
+    and the versions of the alignment and of the arrays"""
+    return '{}-{}-{}'.format(file_hash(train_dir), helper.ALIGNMENT_VERSION,
+                             STORE_VERSION)
+
+
+def deduplicate(data, columns=('source', 'target', 'pos_info')):
+    """Collapses the rows of data equal on columns into the first of them,
+    whose 'weight' is the number of rows collapsed (the sum of their weights
+    if data is weighted already). Hashes every row once."""
+    weights = pd.Series(helper.row_weights(data), index=data.index)
+    grouped = weights.groupby([data[column] for column in columns],
+                              sort=False, dropna=False).sum()
+    return grouped.rename('weight').reset_index()
+
+
+def first_appearance(ids, table):
+    """Renumbers the codes ids (into table) by order of first appearance in
+    ids, dropping the unused entries of table. Returns (ids, table)."""
+    used, first, inverse = np.unique(ids, return_index=True,
+                                     return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.ravel()], table[used[order]]
+
+
+class LanguageData(object):
+    """
+    A training file deduplicated, aligned and coded once. `data` holds the
+    aligned rows and their weights, `relation` the (object_ids,
+    attribute_ids, objects, attributes, weights) of helper.relation_codes,
+    the pairs of row i being relation[k][offsets[i]:offsets[i + 1]], and
+    `pos_rows` maps every POS tag to the sorted array of the rows carrying
+    it.
+    """
+
+    def __init__(self, data, relation, offsets, pos_rows):
+        self.data = data
+        self.relation = relation
+        self.offsets = offsets
+        self.pos_rows = pos_rows
+
+    @classmethod
+    def from_frame(cls, data, cache=None, workers=None):
+        """Deduplicates, aligns and codes a frame with 'source', 'target' and
+        'pos_info' columns, see helper.batch_align for cache and workers"""
+        data = helper.align_frame(deduplicate(data), workers, cache)
+        relation = helper.relation_codes(data)
+        counts = np.fromiter(
+            (len(deleted) + len(added) for deleted, added in
+             zip(data['deleted'], data['added'])),
+            dtype=np.int64, count=len(data))
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        pos_rows = collections.defaultdict(list)
+        for row, pos_group in enumerate(data['pos_info'].tolist()):
+            for pos in set(pos_group.split(';')):
+                pos_rows[pos].append(row)
+        pos_rows = dict((pos, np.array(rows, dtype=np.int64))
+                        for pos, rows in pos_rows.items())
+        return cls(data, relation, offsets, pos_rows)
+
+    @classmethod
+    def from_file(cls, train_dir, cache=None, workers=None):
+        """Loads and preprocesses a training file"""
+        return cls.from_frame(
+            pd.read_csv(train_dir, sep='\t',
+                        names=['source', 'target', 'pos_info']),
+            cache, workers)
+
+    @classmethod
+    def from_store(cls, train_dir, store, cache=None, workers=None):
+        """from_file through the directory store: loads the arrays of
+        train_dir saved there if its contents did not change since, else
+        preprocesses it and saves them (again, if the saved files are
+        damaged). Without a store, from_file."""
+        if not store:
+            return cls.from_file(train_dir, cache, workers)
+        directory = os.path.join(store, os.path.basename(train_dir))
+        key = store_key(train_dir)
+        try:
+            language = cls.load(directory, key)
+        except (OSError, ValueError, KeyError) as error:
+            # .npy files missing or truncated since the save
+            print("Rebuilding the store of {}: {}".format(train_dir, error))
+            language = None
+        if language is None:
+            language = cls.from_file(train_dir, cache, workers)
+            language.save(directory, key)
+        return language
+
+    def arrays(self):
+        """Returns a dict name => numpy array holding the whole state"""
+        arrays = dict((column, np.array(self.data[column].tolist(),
+                                        dtype=str))
+                      for column in TEXT_COLUMNS)
+        arrays['weight'] = helper.row_weights(self.data)
+        for column in helper.ALIGNMENT_COLUMNS:
+            (arrays[column + '_offsets'],
+             arrays[column]) = helper.columnar(self.data[column])
+        for name, array in zip(('object_ids', 'attribute_ids', 'objects',
+                                'attributes', 'weights'), self.relation):
+            arrays['relation_' + name] = array
+        arrays['offsets'] = self.offsets
+        tags = self.pos_tags()
+        arrays['pos_tags'] = np.array(tags, dtype=str)
+        rows = [self.pos_rows[pos] for pos in tags]
+        arrays['pos_offsets'] = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(pos_rows) for pos_rows in rows],
+                  out=arrays['pos_offsets'][1:])
+        arrays['pos_rows'] = np.concatenate(rows + [np.zeros(0, np.int64)])
+        return arrays
+
+    def save(self, directory, key):
+        """Writes arrays() to directory as .npy files, key identifying
+        them for load"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        meta = os.path.join(directory, 'meta.json')
+        # written last, so that an interrupted save is never loaded
+        if os.path.exists(meta):
+            os.remove(meta)
+        arrays = self.arrays()
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+        with open(meta, 'w') as f:
+            json.dump({'key': key, 'arrays': sorted(arrays)}, f)
+
+    @classmethod
+    def load(cls, directory, key):
+        """Memory-maps the arrays saved to directory, None unless they were
+        saved under key"""
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if meta.get('key') != key:
+            return None
+        arrays = dict(
+            (name, np.load(os.path.join(directory, name + '.npy'),
+                           mmap_mode='r'))
+            for name in meta['arrays'])
+        data = pd.DataFrame(dict((column, arrays[column])
+                                 for column in TEXT_COLUMNS))
+        data['weight'] = np.asarray(arrays['weight'])
+        for column in helper.ALIGNMENT_COLUMNS:
+            data[column] = pd.Series(
+                helper.column_lists(arrays[column + '_offsets'],
+                                    arrays[column]),
+                index=data.index, dtype=object)
+        relation = tuple(arrays['relation_' + name] for name in (
+            'object_ids', 'attribute_ids', 'objects', 'attributes', 'weights'))
+        pos_offsets = arrays['pos_offsets']
+        pos_rows = dict(
+            (pos, arrays['pos_rows'][pos_offsets[k]:pos_offsets[k + 1]])
+            for k, pos in enumerate(arrays['pos_tags'].tolist()))
+        return cls(data, relation, arrays['offsets'], pos_rows)
+
+    def pos_tags(self):
+        return sorted(self.pos_rows)
+
+    def subset(self, pos):
+        """Returns the rows of the POS tag pos as a frame, along with their
+        relation coded as by helper.relation_codes on that frame"""
+        return self.select(self.pos_rows[pos])
+
+    def first_by_source(self):
+        """subset of the first row of every source word in the training
+        file, unweighted: the training data of the evaluation scripts"""
+        rows = np.flatnonzero(~self.data['source'].duplicated().to_numpy())
+        data, relation = self.select(rows)
+        return data.drop(columns='weight'), relation[:4]
+
+    def select(self, rows):
+        """subset of the sorted array of row numbers rows"""
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        # indexes of the pairs of the rows
+        pairs = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                 np.arange(lengths.sum()))
+        object_ids, attribute_ids, objects, attributes, weights = \
+            self.relation
+        object_ids, objects = first_appearance(object_ids[pairs], objects)
+        attribute_ids, attributes = first_appearance(attribute_ids[pairs],
+                                                     attributes)
+        data = self.data.iloc[rows].reset_index(drop=True)
+        return data, (object_ids, attribute_ids, objects, attributes,
+                      weights[pairs])